@@ -58,10 +58,22 @@
 import serial
 from serial.tools import list_ports
 import time
+import threading
+import asyncio
+import bisect
 import numpy as np
 from collections import deque
 import warnings
 
+#Ramp/soak program table, one row per location. See TC720.read_program().
+PROGRAM_DTYPE = np.dtype([('location', 'i4'), ('temp', 'f8'), ('ramp_time', 'i4'),
+                          ('soak_time', 'i4'), ('repeats', 'i4'), ('repeat_location', 'i4')])
+#Command character of each program field, followed by the location number.
+PROGRAM_FIELDS = [('temp', 'a'), ('ramp_time', 'b'), ('soak_time', 'c'), ('repeats', 'd'), ('repeat_location', 'e')]
+#Upper edges in ms of the latency histogram bins of TC720.stats(), the last
+#bin counts everything above the last edge.
+LATENCY_BINS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
 #_______________________________________________________________________________
 #   FIND SERIAL PORT
 def find_address(identifier = None):
@@ -117,65 +129,53 @@ def find_address(identifier = None):
     return port[0]
     
 #==============================================================================
-#   TC-720 class
+#   TC-720 protocol
 #==============================================================================
 
-class TC720():
+class TC720Protocol():
     """
-    Class to control the TC-720 temperature controller from TE Technology Inc. 
-    
+    Message format, checksums and stored device state of the TC-720.
+    Shared by the TC720 and AsyncTC720 classes, which add the communication
+    with the device.
+
     """
-    def __init__(self, address = None, serial_number = None, name = 'TC-720', default_temp = None, verbose = False):
+    #Divider to convert the response of read commands to the real value.
+    #Temperatures are send in 1/100 degree Celsius, output levels in 1/511.
+    response_scale = {'01': 100, '04': 100, '50': 100, '02': 511.0, '74': 511.0}
+    response_scale.update({'a' + hex(location + 7)[-1]: 100 for location in range(1, 9)})
+
+    #Read command for writable registers, used by load_registers().
+    read_commands = {'1c': '50', '3d': '71', '3f': '73', '40': '74'}
+    read_commands.update({c + str(location - 1): c + hex(location + 7)[-1] for c in ['a', 'b', 'c', 'd', 'e'] for location in range(1, 9)})
+
+    def init_state(self, name, verbose, state_ttl):
         """
-        Input:
-        `address`(str): The address of TC-720. Use the "find_address()" function
-            to find the address. It should have the format of 'ComX' on Windows
-            and 'dev/ttyUSBX' in linux, where X is the address number.
-        `name`(str): Custom name of the TC-720. Useful if there are multiple
-            units connected. Default = TC-720.
-        `mode`(int 0-2): The mode of operation:
-            0: Normal Set Mode; maintain one value. This can be one temperature
-            one output power or output by an external power source. See 
-            control_type for options.
-            1: Ramp/Soak Mode: This mode is used to program a specific 
-            temperature and time sequence.
-            2: Proportional+Dead Band mode; (limited to no support yet)
-            Default = 0 (set one value)
-        `control_type`(int 0-2): If mode is 0 the controller can maintain
-            one temperature (0), one output power(1) or an analogue 
-            output by another power source (2).
-            Default = 0 (set one temperature
-        `default_temp`(int): Default temperature in degree centigrade.
-            Default = 20C
-        `verbose`(bool): Option to print status messages.
+        Set the name and the stored device state. See TC720 for the input.
 
         """
-        self.address = address
         self.name = name
         self.verbose = verbose
         self.verboseprint = print if self.verbose else lambda *a, **k: None
 
-        # connect to the controller
-        if serial_number != None:
-            ports_TC720 = [ p.device for p in serial.tools.list_ports.comports() if serial_number == p.serial_number]
-            if not ports_TC720:
-                raise IOError("TC720 with serial number " + serial_number + "not found")
-            if len(ports_TC720) > 1:
-                print('Multiple TC720s with the same serial number found - using the first')
-            self.ser = serial.Serial(ports_TC720[0], timeout= 2, baudrate=230400, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE)
-        else:
-            self.ser = serial.Serial(self.address, timeout= 2, baudrate=230400, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE)
-        self.verboseprint('Made connection with temperature controller: {}'.format(self.name))
+        # stored mode and control type, used by check_mode()
+        self.state_ttl = state_ttl
+        self.mode = None
+        self.control_type = None
+        self.state_time = None
 
-        # set the machine into temperature control if default_temp is not None
-        if default_temp != None:
-            self.set_temp(default_temp)
-            self.set_mode(0)
-            self.set_control_type(0)
-            self.verboseprint('Mode set to: {}, control type set to: {}, temperature set to: {}C'.format(0, 0, self.default_temp))
+        # mirror of the last confirmed value of each writable register
+        self.registers = {}
+        self.pending_registers = {}
+        self.register_hits = 0
+        self.register_misses = 0
+
+        # I/O statistics per command, see stats()
+        self.io_stats = {}
+        self.pending_commands = deque()
+        self.stats_hook = None
 
     #==========================================================================
-    #    Functions for sending and reading messages
+    #    Message format
     #==========================================================================
 
     def int_to_hex(self, integer):
@@ -293,6 +293,323 @@ class TC720():
         
         return message
 
+    def message_to_bytes(self, message):
+        """
+        Convert a message from the self.message_builder() function to the
+        frame that is written to the serial port.
+        Input:
+        `message`(list): Message with 10 bits as individual ASCII stings.
+        Returns the frame as byte-string, like: b'*01000021\\r'
+
+        """
+        if type(message) == bytes:
+            return message
+        return ''.join(message).encode('ascii')
+
+    def decode_response(self, command, response):
+        """
+        Convert the response to a read command to its value. Temperatures are
+        returned in degree Celsius, output levels in the range -1 to 1 and all
+        other values as integer. See self.response_scale.
+        Input:
+        `command`(str): Command character with length 2.
+        `response`(bytes): Response of the temperature control unit.
+
+        """
+        value = self.response_to_int(response)
+        if command in self.response_scale:
+            return value / self.response_scale[command]
+        return value
+
+    def validate_data(self, input):
+        """
+        Check if the input for a location is valid.
+
+        """
+        if type(input) != int or not 1 <= input <= 8:
+            raise ValueError('Invalid location: "{}", type: "{}. Must be an integer in the range 1-8.'.format(input, type(input)))
+
+    #==========================================================================
+    #    Register mirror
+    #    The last confirmed value of every writable register is stored, so
+    #    writes of a value the device already holds can be skipped.
+    #==========================================================================
+
+    def stage_register(self, command, value):
+        """
+        Store a new register value without sending it. Staged values that 
+        differ from the device are send by self.sync().
+        Input:
+        `command`(str): Command character with length 2.
+        `value`(str): Value characters with length 4, use self.int_to_hex().
+
+        """
+        if self.registers.get(command) == value:
+            self.pending_registers.pop(command, None)
+            self.register_hits += 1
+        else:
+            self.pending_registers[command] = value
+
+    def invalidate_registers(self):
+        """
+        Forget all stored register values, so the next write of every 
+        register is send to the device. Use this if the settings are changed
+        on the device itself.
+
+        """
+        self.registers.clear()
+
+    def register_stats(self):
+        """
+        Returns a dictionary with the number of register writes that were
+        skipped ("hits") and send ("misses").
+
+        """
+        return {'hits': self.register_hits, 'misses': self.register_misses}
+
+    #==========================================================================
+    #    I/O statistics
+    #    Every frame that is send is matched with the next reply, in order, 
+    #    to count the outcome and the latency per command.
+    #==========================================================================
+
+    def command_stats(self, command):
+        """
+        Returns the counters of one command, see self.stats().
+
+        """
+        stats = self.io_stats.get(command)
+        if stats == None:
+            stats = {'sent': 0, 'write_attempts': 0, 'retries': 0, 'replies': 0,
+                     'timeouts': 0, 'device_checksum_errors': 0, 
+                     'reply_checksum_errors': 0, 'bytes_out': 0, 'bytes_in': 0,
+                     'latency_sum': 0.0, 'latency_max': 0.0,
+                     'latency_histogram': [0] * (len(LATENCY_BINS) + 1)}
+            self.io_stats[command] = stats
+        return stats
+
+    def match_responses(self, reads, count):
+        """
+        Match the reads of a batch of `count` commands with the commands.
+        A read that timed out, or that holds more than one frame because a
+        terminator '^' was lost, can not be matched. That command and all 
+        following commands get None and have to be repeated one by one.
+        Input:
+        `reads`(list): Byte-strings as read, with all bytes before the 
+            terminator, see the `trim` input of self.read_message().
+        `count`(int): Number of commands in the batch.
+        Returns:
+        List with the response of each command, or None.
+
+        """
+        responses = [None] * count
+        for n, response in enumerate(reads[:count]):
+            if not response.endswith(b'^') or response.count(b'*') != 1:
+                break
+            responses[n] = response
+        return responses
+
+    def record_sent(self, frame):
+        """
+        Count the frames in `frame`, one or more messages of 10 bytes, and 
+        wait for their replies.
+
+        """
+        now = time.perf_counter()
+        for i in range(0, len(frame), 10):
+            command = frame[i+1:i+3].decode()
+            stats = self.command_stats(command)
+            stats['sent'] += 1
+            stats['bytes_out'] += 10
+            self.pending_commands.append((command, now))
+
+    def record_reply(self, response):
+        """
+        Match a reply with the oldest frame that waits for one and count it.
+        Returns the outcome: 'ok', 'timeout', 'device_checksum_error' (the 
+        device received a bad message) or 'reply_checksum_error'.
+
+        """
+        if not response.endswith(b'^'):
+            outcome = 'timeout'
+        elif response == b'*XXXX60^':
+            outcome = 'device_checksum_error'
+        elif self.check_checksum(response) == False:
+            outcome = 'reply_checksum_error'
+        else:
+            outcome = 'ok'
+
+        if len(self.pending_commands) == 0:
+            return outcome
+        command, sent = self.pending_commands.popleft()
+        latency = time.perf_counter() - sent
+        stats = self.io_stats[command]
+        stats['bytes_in'] += len(response)
+        if outcome == 'ok':
+            stats['replies'] += 1
+            stats['latency_sum'] += latency
+            if latency > stats['latency_max']:
+                stats['latency_max'] = latency
+            stats['latency_histogram'][bisect.bisect_left(LATENCY_BINS, 1000 * latency)] += 1
+        else:
+            stats[outcome + 's'] += 1
+        if self.stats_hook != None:
+            self.stats_hook(command, outcome, latency)
+        return outcome
+
+    def stats(self):
+        """
+        Snapshot of the I/O statistics.
+        Returns a dictionary with per command code, and the sum of all 
+        commands under 'total', a dictionary with:
+        'sent': Number of frames send.
+        'write_attempts': Number of times a write command was send.
+        'retries': Number of times a command was repeated.
+        'replies': Number of correct replies.
+        'timeouts': Number of replies that did not arrive in time.
+        'device_checksum_errors': Number of *XXXX60^ replies, the device
+            received a message with a bad checksum.
+        'reply_checksum_errors': Number of replies with a bad checksum.
+        'bytes_out', 'bytes_in': Bytes send and received.
+        'latency_mean_ms', 'latency_max_ms': Time between sending a frame and
+            its correct reply.
+        'latency_histogram': Number of correct replies per bin of 
+            LATENCY_BINS (ms).
+        Set self.stats_hook to a function to have it called as
+        hook(command, outcome, latency_in_s) after every reply.
+
+        """
+        snapshot = {}
+        total = None
+        for command, stats in list(self.io_stats.items()):
+            stats = dict(stats, latency_histogram=list(stats['latency_histogram']))
+            if total == None:
+                total = dict(stats, latency_histogram=list(stats['latency_histogram']))
+            else:
+                for key in stats:
+                    if key == 'latency_histogram':
+                        total[key] = [a + b for a, b in zip(total[key], stats[key])]
+                    elif key == 'latency_max':
+                        total[key] = max(total[key], stats[key])
+                    else:
+                        total[key] += stats[key]
+            snapshot[command] = stats
+        if total != None:
+            snapshot['total'] = total
+        for stats in snapshot.values():
+            stats['latency_mean_ms'] = 1000 * stats.pop('latency_sum') / stats['replies'] if stats['replies'] > 0 else 0.0
+            stats['latency_max_ms'] = 1000 * stats.pop('latency_max')
+        return snapshot
+
+    def reset_stats(self):
+        """
+        Clear the I/O statistics. Frames that still wait for a reply are 
+        forgotten too, so their replies are not matched with later frames.
+
+        """
+        self.io_stats = {}
+        self.pending_commands.clear()
+
+#==============================================================================
+#   TC-720 class
+#==============================================================================
+
+class TC720(TC720Protocol):
+    """
+    Class to control the TC-720 temperature controller from TE Technology Inc. 
+    
+    """
+    #Clock used by waitTemp(), with the time() and sleep() functions of the
+    #time module. TC720_simulation replaces it to run faster than real time.
+    clock = time
+
+    def __init__(self, address = None, serial_number = None, name = 'TC-720', default_temp = None, verbose = False, inter_byte_delay = 0, state_ttl = 10):
+        """
+        Input:
+        `address`(str): The address of TC-720. Use the "find_address()" function
+            to find the address. It should have the format of 'ComX' on Windows
+            and 'dev/ttyUSBX' in linux, where X is the address number.
+        `name`(str): Custom name of the TC-720. Useful if there are multiple
+            units connected. Default = TC-720.
+        `mode`(int 0-2): The mode of operation:
+            0: Normal Set Mode; maintain one value. This can be one temperature
+            one output power or output by an external power source. See 
+            control_type for options.
+            1: Ramp/Soak Mode: This mode is used to program a specific 
+            temperature and time sequence.
+            2: Proportional+Dead Band mode; (limited to no support yet)
+            Default = 0 (set one value)
+        `control_type`(int 0-2): If mode is 0 the controller can maintain
+            one temperature (0), one output power(1) or an analogue 
+            output by another power source (2).
+            Default = 0 (set one temperature
+        `default_temp`(int): Default temperature in degree centigrade.
+            Default = 20C
+        `verbose`(bool): Option to print status messages.
+        `inter_byte_delay`(float): Seconds to wait after each character of a
+            message. Only needed for devices or USB adapters that can not keep
+            up with a whole frame in one write. Default = 0 (send the frame in
+            a single write).
+        `state_ttl`(float): Seconds that the stored mode and control type are 
+            trusted before they are read from the device again. The stored
+            state is updated by set_mode() and set_control_type(), and is read
+            again after an error or by calling refresh(). Default = 10 
+            seconds.
+
+        """
+        self.address = address
+        self.init_state(name, verbose, state_ttl)
+        self.inter_byte_delay = inter_byte_delay
+
+        # connect to the controller
+        if serial_number != None:
+            ports_TC720 = [ p.device for p in serial.tools.list_ports.comports() if serial_number == p.serial_number]
+            if not ports_TC720:
+                raise IOError("TC720 with serial number " + serial_number + "not found")
+            if len(ports_TC720) > 1:
+                print('Multiple TC720s with the same serial number found - using the first')
+            self.ser = serial.Serial(ports_TC720[0], timeout= 1, baudrate=230400, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE)
+        else:
+            self.ser = serial.Serial(self.address, timeout= 1, baudrate=230400, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE)
+        self.verboseprint('Made connection with temperature controller: {}'.format(self.name))
+
+        # set the machine into temperature control if default_temp is not None
+        if default_temp != None:
+            self.set_temp(default_temp)
+            self.set_mode(0)
+            self.set_control_type(0)
+            self.verboseprint('Mode set to: {}, control type set to: {}, temperature set to: {}C'.format(0, 0, default_temp))
+
+    #==========================================================================
+    #    Functions for sending and reading messages
+    #==========================================================================
+
+    def write_frame(self, frame):
+        """
+        Write a complete frame to the temperature control unit.
+        If "inter_byte_delay" is set, the frame is written one character at a
+        time with a pause after each character. Otherwise the frame is written
+        in a single call.
+        Input:
+        `frame`(bytes): Frame made by the self.message_to_bytes() function.
+
+        """
+        self.record_sent(frame)
+        if self.inter_byte_delay:
+            for i in range(len(frame)):
+                self.ser.write(frame[i:i+1])
+                time.sleep(self.inter_byte_delay)
+        else:
+            self.ser.write(frame)
+
+    def flush_input(self):
+        """
+        Drop all received bytes, and the frames that still wait for a reply.
+
+        """
+        self.ser.read_all()
+        self.pending_commands.clear()
+
     def send_message(self, message, write=False):
         """
         Send message to the temperature control unit. Use the 
@@ -307,6 +624,8 @@ class TC720():
                 SS: Checksum, 2 bits
                 (etx): End of text character = '\r'
             Format: ['*', 'C', 'C', 'D', 'D', 'D', 'D', 'S', 'S', '\r']
+            A frame from the self.message_to_bytes() function is also
+            accepted.
         `write`(bool): Small trick to make sure a certain message is dealt with
             as a write command (opposed to a read command). The problem is that 
             if a zero is written to the controller the program thinks it is a
@@ -314,8 +633,12 @@ class TC720():
         
         """
         #Make sure the reply buffer is empty
-        self.ser.read_all()
-        
+        self.flush_input()
+
+        #Build the frame once, it is re-used if the write has to be repeated.
+        frame = self.message_to_bytes(message)
+        value = frame[3:7].decode()
+
         #There are 2 types of messages, read commands and write commands.
         #The read command is responded with the requested value.
         #The write command is responded with a repeat of the value to write.
@@ -325,22 +648,22 @@ class TC720():
         #message is properly received. 
         
         #Send read commands
-        if ''.join(message[3:7]) == '0000' and write == False:
-            for i in message:
-                    self.ser.write(str.encode(i))
-                    time.sleep(0.005)
-             
+        if value == '0000' and write == False:
+            self.write_frame(frame)
+
         #Send write commands
         else:
             #Send the message
+            stats = self.command_stats(frame[1:3].decode())
             for n in range(5):
-                for i in message:
-                    self.ser.write(str.encode(i))
-                    time.sleep(0.005)
+                stats['write_attempts'] += 1
+                if n > 0:
+                    stats['retries'] += 1
+                self.write_frame(frame)
 
                 #The controller acknowledges the send command by repeating the value.
                 response = self.read_message(detect_error=False)
-                if response[1:5].decode() == ''.join(message[3:7]):
+                if response[1:5].decode() == value:
                     break
                 #Check if there is an error in the checksum.
                 if response == b'*XXXX60^':
@@ -352,56 +675,250 @@ class TC720():
                     self.verboseprint('    {} Error: Temperature controller did not correctly receive the command.'.format(self.name))
                 time.sleep(0.05)
             else:
-                raise Exception('Could not correctly send "{}" to temperature controller: {}. {}'.format(''.join(message[:-1]), self.name, checksum_error))
+                #The device state is unknown after a failed write.
+                self.state_time = None
+                raise Exception('Could not correctly send "{}" to temperature controller: {}. {}'.format(frame[:-1].decode(), self.name, checksum_error))
     
-    def read_message(self, timeout=1, detect_error=True):
+    def read_message(self, timeout=1, detect_error=True, trim=True):
         """
         Read a message sent by the temperature control unit. 
         
+        The read blocks in the serial driver until the frame terminator '^'
+        arrives and returns as soon as the frame is complete.
         Input
-        `timeout`(int): Time in seconds in which the program will check if 
-            there are messages send by the controller. If it times out it will 
-            throw a warning and return an empty byte-string (b''), which will 
+        `timeout`(int): Time in seconds to wait for the complete frame. If it
+            times out it will throw a warning and return what has been 
+            received so far, usually an empty byte-string (b''), which will 
             probably cause an error in the rest of the code. Default = 1 second.
         `detect_error`(bool): If True, it will check if the controller reports 
             an error in the checksum of the send messages. And it will check if
             the response by the controller has an error in the checksum. It 
             will raise an error if a checksum mistake as been made. 
             Default = True.
+        `trim`(bool): If True, bytes before the last start character '*', 
+            left over from an earlier frame, are dropped. Default = True.
         Returns: 
         The response by the controller as byte-string.     
         
         """
         try:
-            start_time = time.time()
-            while True:
-                #Check if there is a response waiting to be read.
-                if self.ser.in_waiting >= 8:
-                    response =  self.ser.read_all()
-                    
-                    if detect_error == True:
-                        #Check if there is an error in the checksum of the send message.
-                        if response == b'*XXXX60^':
-                            raise Exception ('{} Error: Checksum error in the send message.'.format(self.name))
-                        #Check if there is an error in the checksum of the received message.
-                        if self.check_checksum(response) == False:
-                            raise Exception ('{} Error: Checksum error in the received message.'.format(self.name))
-                        
-                    return response
-                
-                #Timeout check
-                elif (time.time() - start_time) > timeout:
-                    warnings.warn('Did not receive a response from temperature control unit "{}" within timout period.'.format(self.name))
-                    return self.ser.read_all()
-                    break
-                
-                else:
-                    time.sleep(0.05)
-        
+            #The port timeout is the deadline for the whole frame. Only
+            #reconfigure the port if the deadline changes.
+            if self.ser.timeout != timeout:
+                self.ser.timeout = timeout
+            received = self.ser.read_until(b'^')
+
+            #Drop left over bytes of an earlier frame.
+            response = received
+            if response.endswith(b'^'):
+                response = response[response.rfind(b'*'):]
+            outcome = self.record_reply(response)
+            if trim == False:
+                response = received
+
+            #Timeout check
+            if outcome == 'timeout':
+                warnings.warn('Did not receive a response from temperature control unit "{}" within timout period.'.format(self.name))
+                return response
+
+            if detect_error == True:
+                #Check if there is an error in the checksum of the send message.
+                if outcome == 'device_checksum_error':
+                    raise Exception ('{} Error: Checksum error in the send message.'.format(self.name))
+                #Check if there is an error in the checksum of the received message.
+                if outcome == 'reply_checksum_error':
+                    raise Exception ('{} Error: Checksum error in the received message.'.format(self.name))
+
+            return response
+
         except Exception as e:
             print('{} Error: {}'.format(self.name, e))
+            self.state_time = None
             raise Exception ('Connection error with temperature control unit: {}. Error: {}'.format(self.name, e))
 
+    def query(self, command, retries=5):
+        """
+        Send a single read command and read the response. The command is 
+        repeated if the response has a checksum error.
+        Input:
+        `command`(str): Command character with length 2.
+        `retries`(int): Number of times the command is tried. Default = 5
+        Returns:
+        The response by the controller as byte-string.
+
+        """
+        for n in range(retries):
+            if n > 0:
+                self.command_stats(command)['retries'] += 1
+            self.send_message(self.message_builder(command))
+            response = self.read_message(detect_error=False)
+            if response.endswith(b'^') and response != b'*XXXX60^' and self.check_checksum(response):
+                return response
+        raise Exception('Could not read "{}" from temperature controller: {}. Checksum error or no response.'.format(command, self.name))
+
+    def query_many(self, commands, retries=5, decode=True):
+        """
+        Send several read commands back-to-back and read the responses in the
+        order the commands were send. This takes roughly the time of a single
+        round trip instead of one round trip per command.
+        The checksum of every response is checked. A command with a bad 
+        response is repeated on its own once the other responses are read. If
+        a response is missing or two responses are read as one, because a 
+        terminator was lost, that command and all following commands are 
+        repeated one by one, because the responses can no longer be matched 
+        to the commands.
+        Input:
+        `commands`(list): Command characters of read commands, like:
+            ['01', '04', '02'].
+        `retries`(int): Number of times a single command is repeated if the 
+            response is not correct. Default = 5
+        `decode`(bool): If False the responses are returned as byte-strings.
+            Default = True
+        Returns:
+        Tuple with the value of each command, see self.decode_response().
+
+        """
+        #Make sure the reply buffer is empty
+        self.flush_input()
+
+        #Send all frames in one write.
+        self.write_frame(b''.join([self.message_to_bytes(self.message_builder(c)) for c in commands]))
+
+        #Read the responses in order
+        responses = self.match_responses(self.read_batch(len(commands)), len(commands))
+        for n, response in enumerate(responses):
+            if response == b'*XXXX60^' or (response != None and self.check_checksum(response) == False):
+                responses[n] = None
+        if None in responses:
+            #Drop late responses of the batch
+            self.flush_input()
+
+        #Repeat the commands that did not get a correct response
+        for n, command in enumerate(commands):
+            if responses[n] == None:
+                self.verboseprint('    {} Error: Repeating command "{}".'.format(self.name, command))
+                self.command_stats(command)['retries'] += 1
+                responses[n] = self.query(command, retries)
+
+        if decode == False:
+            return tuple(responses)
+        return tuple([self.decode_response(c, r) for c, r in zip(commands, responses)])
+
+    def read_batch(self, count):
+        """
+        Read the responses of `count` commands that were send together. The
+        reads are not trimmed, so a read that holds several frames, because a
+        terminator was lost, counts for all of them. Reading stops after a
+        timeout.
+        Returns:
+        List of the reads as byte-strings, see self.match_responses().
+
+        """
+        reads = []
+        frames = 0
+        while frames < count:
+            response = self.read_message(detect_error=False, trim=False)
+            reads.append(response)
+            if not response.endswith(b'^'):
+                break
+            frames += max(response.count(b'*'), 1)
+        return reads
+
+    #==========================================================================
+    #    Register mirror
+    #    The last confirmed value of every writable register is stored, so
+    #    writes of a value the device already holds can be skipped.
+    #==========================================================================
+
+    def write_register(self, command, value, force=False):
+        """
+        Write a value to a register, unless the device already holds it.
+        Input:
+        `command`(str): Command character with length 2.
+        `value`(str): Value characters with length 4, use self.int_to_hex().
+        `force`(bool): If True the value is always send. Default = False
+        Returns True if the value was send, False if it was skipped.
+
+        """
+        self.pending_registers.pop(command, None)
+        if force == False and self.registers.get(command) == value:
+            self.register_hits += 1
+            return False
+
+        self.register_misses += 1
+        #The register value is unknown until the write is confirmed.
+        self.registers.pop(command, None)
+        self.send_message(self.message_builder(command, value), write=True)
+        self.registers[command] = value
+        return True
+
+    def sync(self):
+        """
+        Send all staged register values that differ from the device in one
+        batch, see self.write_many().
+        Returns the number of registers that were written.
+
+        """
+        pending = dict(self.pending_registers)
+        self.pending_registers.clear()
+        if pending:
+            self.write_many(pending)
+        return len(pending)
+
+    def write_many(self, registers):
+        """
+        Send several write commands back-to-back and check the 
+        acknowledgements in the order the commands were send. A command that 
+        is not acknowledged correctly is repeated on its own with 
+        self.send_message(). Values are always send, use self.stage_register()
+        and self.sync() to skip unchanged values.
+        Input:
+        `registers`(dict): Command character as key, value characters as 
+            value, like: {'a0': '0bb8', 'b0': '003c'}
+
+        """
+        items = list(registers.items())
+        self.register_misses += len(items)
+        for command, value in items:
+            self.registers.pop(command, None)
+
+        #Make sure the reply buffer is empty
+        self.flush_input()
+
+        #Send all frames in one write.
+        for command, value in items:
+            self.command_stats(command)['write_attempts'] += 1
+        self.write_frame(b''.join([self.message_to_bytes(self.message_builder(c, v)) for c, v in items]))
+
+        #The controller acknowledges each command by repeating the value.
+        responses = self.match_responses(self.read_batch(len(items)), len(items))
+        confirmed = [response != None and response[1:5].decode().lower() == value for response, (command, value) in zip(responses, items)]
+        if False in confirmed:
+            #Drop late acknowledgements of the batch
+            self.flush_input()
+
+        #Repeat the commands that were not acknowledged
+        for n, (command, value) in enumerate(items):
+            if confirmed[n] == False:
+                self.verboseprint('    {} Error: Repeating command "{}".'.format(self.name, command))
+                self.command_stats(command)['retries'] += 1
+                self.send_message(self.message_builder(command, value), write=True)
+            self.registers[command] = value
+
+    def load_registers(self, commands=None):
+        """
+        Read the current value of registers from the device into the mirror.
+        Input:
+        `commands`(list): Write command characters of the registers to read. 
+            Default = None, all registers in self.read_commands.
+
+        """
+        if commands == None:
+            commands = list(self.read_commands)
+        responses = self.query_many([self.read_commands[c] for c in commands], decode=False)
+        for command, response in zip(commands, responses):
+            self.registers[command] = response[1:5].decode().lower()
+
     #==========================================================================
     #    Read functions
     #==========================================================================
@@ -435,7 +952,8 @@ class TC720():
         """
         #Ask for mode
         self.send_message(self.message_builder('71'))
-        return self.response_to_int(self.read_message())
+        self.mode = self.response_to_int(self.read_message())
+        return self.mode
 
     def get_control_type(self):
         """
@@ -449,7 +967,8 @@ class TC720():
 
         """
         self.send_message(self.message_builder('73'))
-        return self.response_to_int(self.read_message())
+        self.control_type = self.response_to_int(self.read_message())
+        return self.control_type
 
     def get_set_temp(self):
         """
@@ -587,20 +1106,24 @@ class TC720():
         self.send_message(self.message_builder(location_code))
         return self.response_to_int(self.read_message())
 
-    def validate_data(self, input):
+    def refresh(self):
         """
-        Check if the input for a location is valid.
+        Read the mode and control type from the device and store them.
+        Returns the mode and control type.
 
         """
-        if type(input) != int or not 1 <= input <= 8:
-            raise ValueError('Invalid location: "{}", type: "{}. Must be an integer in the range 1-8.'.format(input, type(input)))
-
+        self.mode, self.control_type = self.query_many(['71', '73'])
+        self.registers['3d'] = self.int_to_hex(self.mode)
+        self.registers['3f'] = self.int_to_hex(self.control_type)
+        self.state_time = time.monotonic()
+        return self.mode, self.control_type
 
     def check_mode(self, desired_mode):
         """
         Check if the machine is in the desired mode.
         Used to check if machine is in the corresponding mode to execute a 
-        function.
+        function. Uses the stored mode, which is only read from the device 
+        if it is older than "state_ttl" seconds, see refresh().
         Input:
         `desired_mode`(int): Desired mode 0, 1 or 2.
         Returns True or False and gives a warning if False
@@ -609,7 +1132,9 @@ class TC720():
         if desired_mode not in [0, 1, 2]:
             raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(desired_mode)))
 
-        cur_mode = self.get_mode()
+        if self.state_time == None or time.monotonic() - self.state_time > self.state_ttl:
+            self.refresh()
+        cur_mode = self.mode
         if not  cur_mode == desired_mode:
             warnings.warn('TC720: {} is not set in the right mode to use this function. Current mode: {}, set the machine in the {} mode using set_mode({})'.format(self.name, cur_mode, desired_mode, desired_mode))
             return False
@@ -619,7 +1144,7 @@ class TC720():
     #    Set functions for the operation modes
     #==========================================================================
 
-    def set_mode(self, mode):
+    def set_mode(self, mode, force=False):
         """
         Set the mode of the temperature control unit.
         Input:
@@ -630,6 +1155,8 @@ class TC720():
             1 = Ramp/Soak. Use the 8 ramp/soak sequences to program a 
                 temperature cycle.
             2 = Proportional+Dead Band
+        `force`(bool): If True the value is always send, also if the device
+            should already hold it. Default = False
         
         """
         #Check input
@@ -637,11 +1164,12 @@ class TC720():
             raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(mode)))
         
         #Set the mode
-        self.send_message(self.message_builder('3d',  self.int_to_hex(mode)), write=True)
+        self.write_register('3d', self.int_to_hex(mode), force)
+        self.mode = mode
         self.verboseprint('Mode set to: {}'.format(mode))
 
 
-    def set_control_type(self, control_type):
+    def set_control_type(self, control_type, force=False):
         """
         Set the control mode of the temperature control unit.
         Relevant only if the mode is set to 0 (Normal set)
@@ -651,6 +1179,8 @@ class TC720():
             1 = Manual, set a fixed output power level.
             2 = Analog Out, Use with external variable voltage
             supply.
+        `force`(bool): If True the value is always send, also if the device
+            should already hold it. Default = False
 
         """
         #Check input
@@ -661,7 +1191,8 @@ class TC720():
         self.check_mode(0)
 
         #Set the control type
-        self.send_message(self.message_builder('3f',  self.int_to_hex(control_type)), write=True)
+        self.write_register('3f', self.int_to_hex(control_type), force)
+        self.control_type = control_type
         self.verboseprint('Control type set to: {}'.format(control_type))
 
     #---------------------------------------------------------------------------
@@ -684,14 +1215,16 @@ class TC720():
         
         #Set the temperature
         temperature = int(temperature * 100)
-        self.send_message(self.message_builder('1c',  self.int_to_hex(temperature)), write=True)
+        self.write_register('1c', self.int_to_hex(temperature))
         self.verboseprint('Temperature set to: {}C'.format(temperature/100))
 
-    def set_output(self, output):
+    def set_output(self, output, force=False):
         """
         Set the output to a specific value.
         Input:
         `output`(int): range -511 to 511 for -100% to 100% output.
+        `force`(bool): If True the value is always send, also if the device
+            should already hold it. Default = False
 
         Only works in the Normal set mode: set_mode(0) and control
         type Manual: set_control(1)
@@ -699,7 +1232,7 @@ class TC720():
         #Check mode
         self.check_mode(0)
 
-        self.send_message(self.message_builder('40',  self.int_to_hex(output)), write=True)
+        self.write_register('40', self.int_to_hex(output), force)
         self.verboseprint('Output set to: {}'.format(output))
 
     def set_output_enable(self,enable):
@@ -708,7 +1241,7 @@ class TC720():
         Input:
         `enable: 0:off, 1: on.
         """
-        self.send_message(self.message_builder('30',  self.int_to_hex(enable)), write=True)
+        self.write_register('30', self.int_to_hex(enable))
         self.verboseprint('Output Enable set to: {}'.format(enable))
 
 
@@ -738,7 +1271,7 @@ class TC720():
             temperature = 2**16 + temperature
         
         #Set soak temperature
-        self.send_message(self.message_builder(location_code, self.int_to_hex(temperature)), write=True)
+        self.write_register(location_code, self.int_to_hex(temperature))
 
     def set_ramp_time(self, location, time):
         """
@@ -756,7 +1289,7 @@ class TC720():
         
         #Set ramp time
         location_code = 'b' + str(location-1)
-        self.send_message(self.message_builder(location_code, self.int_to_hex(time)), write=True)
+        self.write_register(location_code, self.int_to_hex(time))
 
     def set_soak_time(self, location, time):
         """
@@ -776,7 +1309,7 @@ class TC720():
             
         #set soak time
         location_code = 'c' + str(location-1)
-        self.send_message(self.message_builder(location_code, self.int_to_hex(time)), write=True)
+        self.write_register(location_code, self.int_to_hex(time))
 
     def set_repeats(self, location, repeats):
         """
@@ -798,7 +1331,7 @@ class TC720():
         self.check_mode(1)
         
         location_code = 'd' + str(location-1)
-        self.send_message(self.message_builder(location_code, self.int_to_hex(repeats)), write=True)
+        self.write_register(location_code, self.int_to_hex(repeats))
 
     def set_repeat_location(self, location, repeat_loc):
         """
@@ -816,7 +1349,7 @@ class TC720():
         self.check_mode(1)
         
         location_code = 'e' + str(location-1)
-        self.send_message(self.message_builder(location_code, self.int_to_hex(repeat_loc)), write=True)
+        self.write_register(location_code, self.int_to_hex(repeat_loc))
 
     def set_sensor1_choice(self, sensor_choice):
         """
@@ -837,7 +1370,7 @@ class TC720():
             raise ValueError('Invalid input: {}, should be integer 0, 1, 2, 3, 4, 5, 6'.format(repr(control_type)))
 
         #Set the control type
-        self.send_message(self.message_builder('20',  self.int_to_hex(sensor_choice)), write=True)
+        self.write_register('20', self.int_to_hex(sensor_choice))
         self.verboseprint('Sensor 1 choice set to: {}'.format(sensor_choice))
 
     def set_sensor2_choice(self, sensor_choice):
@@ -859,7 +1392,7 @@ class TC720():
             raise ValueError('Invalid input: {}, should be integer 0, 1, 2, 3, 4, 5, 6'.format(repr(control_type)))
 
         #Set the control type
-        self.send_message(self.message_builder('47',  self.int_to_hex(sensor_choice)), write=True)
+        self.write_register('47', self.int_to_hex(sensor_choice))
         self.verboseprint('Sensor 2 choice set to: {}'.format(sensor_choice))
 
 
@@ -890,12 +1423,29 @@ class TC720():
 
     def set_idle(self):
         """
-        Set in to output control mode with 0 output.
+        Set in to output control mode with 0 output. The values are always 
+        send, also if the register mirror holds them.
+
+        """
+        self.set_mode(0, force=True)
+        self.set_output(0, force=True)
+        self.set_control_type(1, force=True)
 
+    def hold_temp(self, temperature):
         """
+        Set the Normal set mode with the PID control type and hold a 
+        temperature. The mode and control type are read from the device if 
+        the stored ones are older than "state_ttl" seconds, and only written
+        if they differ.
+        Input:
+        `temperature`(float): Temperature in degree Celsius
+
+        """
+        if self.state_time == None or time.monotonic() - self.state_time > self.state_ttl:
+            self.refresh()
         self.set_mode(0)
-        self.set_output(0)
-        self.set_control_type(1)
+        self.set_control_type(0)
+        self.set_temp(temperature)
 
     #==========================================================================
     #    Combined functions
@@ -910,7 +1460,8 @@ class TC720():
         Input:
         `location`(list, int or str): Specify one location as an integer (1-8).
             Or specify multiple locations as a list of integers. Or use the 
-            keyword "all" to retrieve data of all locations (takes 4-5 seconds)
+            keyword "all" to retrieve data of all locations. All values are 
+            requested in one batch with self.query_many().
         Returns:
         Array of the data. The first row contains the headers of the table:
         ['Loc', 'Temp', 'Ramp time', 'Soak time', 'Repeats', 'Repeat loc']
@@ -921,6 +1472,7 @@ class TC720():
         'Repeats': The number of times the step (location) should be repeated.
         'Repeat loc': The next step in the sequence. 
         The subsequent rows contain the data of the different locations. 
+        Use self.read_program() to get the table as numbers.
         
         """
         #Initiate the array with the headers
@@ -932,24 +1484,89 @@ class TC720():
         elif type(location) != list:
             location = [location]
          
-        #Add the data to the array
+        #Soak temp, ramp time, soak time, repeats and repeat location codes
+        commands = []
         for i in location:
-            seq = np.append(seq, [[i, self.get_soak_temp(i), self.get_ramp_time(i), self.get_soak_time(i), self.get_repeats(i), self.get_repeat_location(i)]], axis=0)    
+            self.validate_data(i)
+            commands += [c + hex(i + 7)[-1] for c in ['a', 'b', 'c', 'd', 'e']]
+        values = self.query_many(commands)
+
+        #Add the data to the array
+        for n, i in enumerate(location):
+            seq = np.append(seq, [[i] + list(values[5*n : 5*n+5])], axis=0)
         
         return seq
 
-    def set_single_sequence(self, location, temp=20, ramp_time=60, 
-                            soak_time=30000, repeats=1, go_to=None):
+    def read_program(self):
         """
-        Set the ramp and temperature settings of one location. 
+        Read the ramp/soak settings of all 8 locations in one batch.
+        Returns:
+        Numpy structured array with one row per location and the fields:
+        'location', 'temp' (degree Celsius), 'ramp_time' (seconds), 
+        'soak_time' (seconds), 'repeats' and 'repeat_location'.
+        Use it like: program['temp'] or program[0].
+
+        """
+        commands = [code + hex(location + 7)[-1] for location in range(1, 9) for field, code in PROGRAM_FIELDS]
+        values = self.query_many(commands)
+
+        program = np.zeros(8, dtype=PROGRAM_DTYPE)
+        program['location'] = np.arange(1, 9)
+        for n, (field, code) in enumerate(PROGRAM_FIELDS):
+            program[field] = values[n::len(PROGRAM_FIELDS)]
+        return program
+
+    def write_program(self, program, read_device=True):
+        """
+        Write the ramp/soak settings of one or more locations. Only the 
+        fields that differ from the device are written, in one batch.
         Input:
-        `location`(int): Location to alter (1-8).
-        `temp`(float, max 2 decimals): Target temperature in Celsius.
-        `ramp_time`(int): Time it has to take to ramp up to the target 
-            temperature.
-        `soak_time`(int): Time the temperature has to be kept at the target
-            temperature. In seconds, max = 30000 seconds. 
-            Actually it should be 32767, which is 0.5 * 2**16, but higher
+        `program`(array): Numpy structured array with the fields of 
+            PROGRAM_DTYPE, like the output of self.read_program(). A list of 
+            (location, temp, ramp_time, soak_time, repeats, repeat_location)
+            tuples is also accepted.
+        `read_device`(bool): If True the current table is read from the
+            device first, otherwise the values stored by earlier reads and
+            writes are trusted. Default = True
+        Returns the number of fields that were written.
+
+        """
+        program = np.asarray(program)
+        if program.dtype.names == None:
+            program = np.array([tuple(row) for row in program], dtype=PROGRAM_DTYPE)
+        program = np.atleast_1d(program)
+
+        #Check input
+        for row in program:
+            self.validate_data(int(row['location']))
+            self.validate_data(int(row['repeat_location']))
+        #Check mode
+        self.check_mode(1)
+
+        if read_device == True:
+            self.load_registers([code + str(int(row['location']) - 1) for row in program for field, code in PROGRAM_FIELDS])
+
+        for row in program:
+            location = int(row['location'])
+            for field, code in PROGRAM_FIELDS:
+                value = row[field]
+                if field == 'temp':
+                    value = round(value * 100)
+                self.stage_register(code + str(location - 1), self.int_to_hex(int(value)))
+        return self.sync()
+
+    def set_single_sequence(self, location, temp=20, ramp_time=60, 
+                            soak_time=30000, repeats=1, go_to=None):
+        """
+        Set the ramp and temperature settings of one location. 
+        Input:
+        `location`(int): Location to alter (1-8).
+        `temp`(float, max 2 decimals): Target temperature in Celsius.
+        `ramp_time`(int): Time it has to take to ramp up to the target 
+            temperature.
+        `soak_time`(int): Time the temperature has to be kept at the target
+            temperature. In seconds, max = 30000 seconds. 
+            Actually it should be 32767, which is 0.5 * 2**16, but higher
             values gives checksum errors sometimes.
         `repeats`(int): Number of times the location has to be repeated. The
             program will cycle over all 8 locations in sequence and counts how 
@@ -998,7 +1615,8 @@ class TC720():
             threshold value, the temperature has been reached and is stable.
             Default = 0.01
         `timeout`(float): Number of minutes after which the program times-out.
-            It will raise and exception if the temperature could not be 
+            The time is measured with the clock of the device, not by counting
+            the readings. It will raise and exception if the temperature could not be 
             reached withing the timeout period if "set_idle" is "True", 
             otherwise it will only raise an Warning.
         `set_idle`(bool): If True it will set the controller to idle if the 
@@ -1007,26 +1625,21 @@ class TC720():
             errors on the controller.
             
         """
-        bufferT = deque(maxlen=array_size)
-        counter = 0
+        detector = StabilityDetector(target_temp, error, array_size, sd)
+        start = self.clock.time()
 
         while True:
-            tic = time.time()
+            tic = self.clock.time()
 
             cur_temp = self.get_temp()
-            bufferT.append(cur_temp)
+            stable = detector.add(tic, cur_temp)
             
-            self.verboseprint('Current temperature: ', cur_temp, ' Standard deviation: ', np.std(bufferT))
-
-            # Check if temp is within the error range of the target_temp
-            if (target_temp-error) < cur_temp < (target_temp+error):
-                self.verboseprint('Within range of target temperature {}C with error {}C'.format( target_temp, error))
-                if counter > array_size:
-                    #Check if slope has plateaus by checking the standard deviation
-                    if np.std(bufferT) < sd:
-                        self.verboseprint('Temperature stable, slope minimal')
-                        break
-            if counter >= (timeout*60): #Raise and exception after the timeout period
+            self.verboseprint('Current temperature: ', cur_temp, ' Standard deviation: ', detector.std())
+
+            if stable == True:
+                self.verboseprint('Temperature stable, slope minimal')
+                break
+            if tic - start >= (timeout*60): #Raise and exception after the timeout period
                 #Make sure there are no errors on the system
                 self.check_error(set_idle=set_idle, raise_exception=True)
             
@@ -1037,14 +1650,12 @@ class TC720():
                     warnings.warn('Temperature could not be reached in {} minutes, check {} system.'.format(timeout, self.name))
                     break
 
-
-            counter +=1        
-            toc = time.time()
+            toc = self.clock.time()
             execute_time = toc - tic
             if execute_time > 1:
                 execute_time = 0.001
             # Check every second
-            time.sleep(1-execute_time)
+            self.clock.sleep(1-execute_time)
 
 
     #==========================================================================
@@ -1101,128 +1712,1097 @@ class TC720():
                 warnings.warn('Error(s) on {}: {}. {}'.format(self.name, current_errors, reset))
                 return [False, 'Error(s) on {}: {}. {}'.format(self.name, current_errors, reset)]
 
-class TC720_simulation():
-    def __init__(self, address = None, serial_number = None, name = 'TC-720', default_temp = None, verbose = False):
-        pass
+#==============================================================================
+#   asyncio TC-720 class
+#==============================================================================
+
+class AsyncTC720(TC720Protocol):
+    """
+    asyncio version of the TC720 class, with the same functions. All
+    functions that talk to the device are coroutines, for instance:
+    `temp = await my_device.get_temp()`. One event loop can drive many 
+    controllers at once, without a thread per device. Commands of different
+    tasks to the same device are send one at a time.
+
+    Use `await AsyncTC720.open(address)` to connect to a serial port. Any 
+    other asyncio stream pair can be given to the constructor, for instance
+    the streams from asyncio.open_connection() to a local stand-in device.
+
+    """
+    def __init__(self, reader, writer, name = 'TC-720', verbose = False, state_ttl = 10):
+        """
+        Input:
+        `reader`(asyncio.StreamReader): Stream with the responses of the 
+            device.
+        `writer`(asyncio.StreamWriter): Stream the messages are written to.
+        `name`, `verbose`, `state_ttl`: See TC720.
+
+        """
+        self.reader = reader
+        self.writer = writer
+        self.init_state(name, verbose, state_ttl)
+        self.lock = asyncio.Lock()
+        self.flush_needed = False
+
+    @classmethod
+    async def open(cls, address, **kwargs):
+        """
+        Connect to a TC-720 on a serial port. Needs the pyserial-asyncio 
+        package: `pip install pyserial-asyncio`
+        Input:
+        `address`(str): The address of TC-720, see TC720.
+        Other keyword arguments are passed to the constructor.
+        Returns an AsyncTC720 object.
+
+        """
+        try:
+            import serial_asyncio
+        except ImportError:
+            raise ImportError('AsyncTC720.open() needs the pyserial-asyncio package: pip install pyserial-asyncio')
+        reader, writer = await serial_asyncio.open_serial_connection(url=address, baudrate=230400, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE)
+        return cls(reader, writer, **kwargs)
+
+    async def close(self):
+        """
+        Close the connection.
+
+        """
+        self.writer.close()
+        await self.writer.wait_closed()
 
     #==========================================================================
     #    Functions for sending and reading messages
     #==========================================================================
 
-    def int_to_hex(self, integer):
+    async def flush_input(self):
         """
-        Formats integers to hexadecimal encoded string, to use in the 
-        self.message_builder function. Max is 32768.
-        Handles negative numbers
-        
+        Discard responses that arrived after their read timed out, and the
+        responses of frames that were send without reading the response.
+
         """
-        if abs(integer) > 32768:
-            raise ValueError('Can not encode positive or negative integers larger than  32768 in length 4 hexadecimal number.')
+        while True:
+            try:
+                await asyncio.wait_for(self.reader.read(1024), 0.01)
+            except asyncio.TimeoutError:
+                break
+        self.pending_commands.clear()
+        self.flush_needed = False
 
-        #Negative numbers
-        if integer < 0:
-            integer = int(2**16 + integer)
-        
-        return '{h:0>4}'.format(h = hex(integer)[2:])
+    async def exchange(self, frame, count=1, timeout=1, trim=True):
+        """
+        Send one or more frames and read the responses. Frames of other tasks
+        are not send before all responses are read.
+        Input:
+        `frame`(bytes): One frame or several frames joined together.
+        `count`(int): Number of responses to read. Default = 1
+        `timeout`(float): Seconds to wait for each response. Default = 1
+        `trim`(bool): See TC720.read_message(). A read that holds several
+            frames counts for all of them. Default = True
+        Returns:
+        List of the responses as byte-strings. A response that timed out is
+        returned as b'' and ends the list.
+
+        """
+        async with self.lock:
+            if self.flush_needed == True:
+                await self.flush_input()
+            self.record_sent(frame)
+            self.writer.write(frame)
+            await self.writer.drain()
+            responses = []
+            frames = 0
+            while frames < count:
+                response = await self.read_message(timeout, detect_error=False, trim=trim)
+                responses.append(response)
+                if not response.endswith(b'^'):
+                    break
+                frames += max(response.count(b'*'), 1)
+            return responses
 
-    def response_to_int(self, response):
+    async def send_message(self, message, write=False):
         """
-        Returns the integer representation of the response of the 4 data bits.
-        Handles negative numbers.
-        
+        Send message to the temperature control unit, see TC720.send_message().
+        Read commands are only send, use self.query() to send a read command
+        and read the response together.
+
         """
-        response = int(response[1:5], base=16)
-        #Check if it is a negative number, if yes, invert it to the correct value.
-        if response > 0.5 * (2**16): 
-            response = -(2**16 - response)
+        frame = self.message_to_bytes(message)
+        value = frame[3:7].decode()
+
+        #Send read commands
+        if value == '0000' and write == False:
+            async with self.lock:
+                self.record_sent(frame)
+                self.writer.write(frame)
+                await self.writer.drain()
+                #The response is not read, drop it before the next exchange
+                self.flush_needed = True
+
+        #Send write commands
+        else:
+            checksum_error = ''
+            stats = self.command_stats(frame[1:3].decode())
+            for n in range(5):
+                stats['write_attempts'] += 1
+                if n > 0:
+                    stats['retries'] += 1
+                #The controller acknowledges the send command by repeating the value.
+                response = (await self.exchange(frame))[0]
+                if response[1:5].decode() == value:
+                    break
+                #Check if there is an error in the checksum.
+                if response == b'*XXXX60^':
+                    checksum_error = 'Checksum error'
+                    print('    {} Error: Checksum error.'.format(self.name))
+                else:
+                    checksum_error = ''
+                    self.verboseprint('    {} Error: Temperature controller did not correctly receive the command.'.format(self.name))
+                await asyncio.sleep(0.05)
+            else:
+                #The device state is unknown after a failed write.
+                self.state_time = None
+                raise Exception('Could not correctly send "{}" to temperature controller: {}. {}'.format(frame[:-1].decode(), self.name, checksum_error))
+
+    async def read_message(self, timeout=1, detect_error=True, trim=True):
+        """
+        Read a message sent by the temperature control unit, see 
+        TC720.read_message().
+
+        """
+        try:
+            response = await asyncio.wait_for(self.reader.readuntil(b'^'), timeout)
+        except asyncio.TimeoutError:
+            self.record_reply(b'')
+            warnings.warn('Did not receive a response from temperature control unit "{}" within timout period.'.format(self.name))
+            self.flush_needed = True
+            return b''
+        except Exception as e:
+            self.state_time = None
+            raise Exception ('Connection error with temperature control unit: {}. Error: {}'.format(self.name, e))
+
+        #Drop left over bytes of an earlier frame.
+        outcome = self.record_reply(response[response.rfind(b'*'):])
+        if trim == True:
+            response = response[response.rfind(b'*'):]
+
+        if detect_error == True:
+            if outcome == 'device_checksum_error':
+                raise Exception ('{} Error: Checksum error in the send message.'.format(self.name))
+            if outcome == 'reply_checksum_error':
+                raise Exception ('{} Error: Checksum error in the received message.'.format(self.name))
+
         return response
 
-    def make_checksum(self, message):
+    async def query(self, command, retries=5):
         """
-        Make the 2 bit checksum for messages. It calculates the 8 bit, modulo 
-        256 checksum in the format of 2 ASCII hex characters.
-        Returns the checksum as a string.
-        
+        Send a single read command and read the response, see TC720.query().
+
         """
-        if type(message) == list:
-            message = ''.join(message)
-            
-        if type(message) == bytes:
-            message = message.decode()
-            
-        checksum = hex(sum(message[1:7].encode('ascii')) % 256)[-2:]
-        return checksum
+        frame = self.message_to_bytes(self.message_builder(command))
+        for n in range(retries):
+            if n > 0:
+                self.command_stats(command)['retries'] += 1
+            response = (await self.exchange(frame))[0]
+            if response.endswith(b'^') and response != b'*XXXX60^' and self.check_checksum(response):
+                return response
+        raise Exception('Could not read "{}" from temperature controller: {}. Checksum error or no response.'.format(command, self.name))
 
-    def check_checksum(self, response):
+    async def query_many(self, commands, retries=5, decode=True):
         """
-        Checks if the checksum of the response is correct.
-        Input:
-        `response`(bytes): Response of the temperature control unit. 8 bits.
-        Returns True or False
-        
+        Send several read commands back-to-back and read the responses in
+        order, see TC720.query_many().
+
         """
-        response = response.decode()
-        #Get checksum send by the controller
-        response_checksum = response[5:7]
-        #Calculate the checksum of the received response.
-        calculated_checksum = hex(sum(response[1:5].encode('ascii')) % 256)#[-2:]
-        if len(calculated_checksum) == 3:
-            calculated_checksum = '{c:0>2}'.format(c = calculated_checksum[-1])
-        else:
-            calculated_checksum = calculated_checksum[-2:]
-                
-        if response_checksum == calculated_checksum:
-            return True
-        else:
+        frame = b''.join([self.message_to_bytes(self.message_builder(c)) for c in commands])
+        received = await self.exchange(frame, len(commands), trim=False)
+
+        responses = self.match_responses(received, len(commands))
+        for n, response in enumerate(responses):
+            if response == b'*XXXX60^' or (response != None and self.check_checksum(response) == False):
+                responses[n] = None
+
+        #Repeat the commands that did not get a correct response
+        for n, command in enumerate(commands):
+            if responses[n] == None:
+                self.verboseprint('    {} Error: Repeating command "{}".'.format(self.name, command))
+                self.command_stats(command)['retries'] += 1
+                responses[n] = await self.query(command, retries)
+
+        if decode == False:
+            return tuple(responses)
+        return tuple([self.decode_response(c, r) for c, r in zip(commands, responses)])
+
+    #==========================================================================
+    #    Register mirror
+    #==========================================================================
+
+    async def write_register(self, command, value, force=False):
+        """
+        Write a value to a register, unless the device already holds it. See
+        TC720.write_register().
+
+        """
+        self.pending_registers.pop(command, None)
+        if force == False and self.registers.get(command) == value:
+            self.register_hits += 1
             return False
 
-    def message_builder(self, command, value='0000'):
+        self.register_misses += 1
+        self.registers.pop(command, None)
+        await self.send_message(self.message_builder(command, value), write=True)
+        self.registers[command] = value
+        return True
+
+    async def sync(self):
         """
-        Constructs the message in the right format.
+        Send all staged register values that differ from the device in one
+        batch, see TC720.sync().
+
+        """
+        pending = dict(self.pending_registers)
+        self.pending_registers.clear()
+        if pending:
+            await self.write_many(pending)
+        return len(pending)
+
+    async def write_many(self, registers):
+        """
+        Send several write commands back-to-back and check the 
+        acknowledgements in order, see TC720.write_many().
+
+        """
+        items = list(registers.items())
+        self.register_misses += len(items)
+        for command, value in items:
+            self.registers.pop(command, None)
+
+        for command, value in items:
+            self.command_stats(command)['write_attempts'] += 1
+        frame = b''.join([self.message_to_bytes(self.message_builder(c, v)) for c, v in items])
+        responses = self.match_responses(await self.exchange(frame, len(items), trim=False), len(items))
+
+        for response, (command, value) in zip(responses, items):
+            if response == None or response[1:5].decode().lower() != value:
+                self.verboseprint('    {} Error: Repeating command "{}".'.format(self.name, command))
+                self.command_stats(command)['retries'] += 1
+                await self.send_message(self.message_builder(command, value), write=True)
+            self.registers[command] = value
+
+    async def load_registers(self, commands=None):
+        """
+        Read the current value of registers from the device into the mirror,
+        see TC720.load_registers().
+
+        """
+        if commands == None:
+            commands = list(self.read_commands)
+        responses = await self.query_many([self.read_commands[c] for c in commands], decode=False)
+        for command, response in zip(commands, responses):
+            self.registers[command] = response[1:5].decode().lower()
+
+    #==========================================================================
+    #    Read functions
+    #==========================================================================
+
+    async def get_temp(self):
+        """Temperature on sensor 1 in degree Celsius."""
+        return (await self.query_many(['01']))[0]
+
+    async def get_temp2(self):
+        """Temperature on sensor 2 in degree Celsius."""
+        return (await self.query_many(['04']))[0]
+
+    async def get_mode(self):
+        """Mode of the temperature control unit, see TC720.get_mode()."""
+        self.mode = (await self.query_many(['71']))[0]
+        return self.mode
+
+    async def get_control_type(self):
+        """Control type, see TC720.get_control_type()."""
+        self.control_type = (await self.query_many(['73']))[0]
+        return self.control_type
+
+    async def get_set_temp(self):
+        """Set temperature of the Normal set mode in degree Celsius."""
+        return (await self.query_many(['50']))[0]
+
+    async def get_output(self):
+        """Current output level in the range -1 to 1."""
+        return (await self.query_many(['02']))[0]
+
+    async def get_set_output(self):
+        """Set manual output in the range -1 to 1."""
+        return (await self.query_many(['74']))[0]
+
+    async def get_ramp_soak_status(self):
+        """Ramp/Soak status, see TC720.get_ramp_soak_status()."""
+        response = (await self.query_many(['09'], decode=False))[0]
+        status_response = '{0:03}'.format(int(bin(int(response[1:5], base=16))[2:]))
+        if status_response == '000':
+            return 'No sequence running'
+        status_list = ['Sequence Running', 'Soak stage', 'Ramp stage']
+        return [status_list[n] for n,i in enumerate(status_response) if i == '1']
+
+    async def get_soak_temp(self, location):
+        """Soak temperature of a location (1-8) in degree Celsius."""
+        self.validate_data(location)
+        return (await self.query_many(['a' + hex(location + 7)[-1]]))[0]
+
+    async def get_ramp_time(self, location):
+        """Ramp time of a location (1-8) in seconds."""
+        self.validate_data(location)
+        return (await self.query_many(['b' + hex(location + 7)[-1]]))[0]
+
+    async def get_soak_time(self, location):
+        """Soak time of a location (1-8) in seconds."""
+        self.validate_data(location)
+        return (await self.query_many(['c' + hex(location + 7)[-1]]))[0]
+
+    async def get_repeats(self, location):
+        """Number of repeats of a location (1-8)."""
+        self.validate_data(location)
+        return (await self.query_many(['d' + hex(location + 7)[-1]]))[0]
+
+    async def get_repeat_location(self, location):
+        """Location that is executed after the location (1-8)."""
+        self.validate_data(location)
+        return (await self.query_many(['e' + hex(location + 7)[-1]]))[0]
+
+    async def refresh(self):
+        """
+        Read the mode and control type from the device and store them.
+
+        """
+        self.mode, self.control_type = await self.query_many(['71', '73'])
+        self.registers['3d'] = self.int_to_hex(self.mode)
+        self.registers['3f'] = self.int_to_hex(self.control_type)
+        self.state_time = time.monotonic()
+        return self.mode, self.control_type
+
+    async def check_mode(self, desired_mode):
+        """
+        Check if the machine is in the desired mode, see TC720.check_mode().
+
+        """
+        if desired_mode not in [0, 1, 2]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(desired_mode)))
+
+        if self.state_time == None or time.monotonic() - self.state_time > self.state_ttl:
+            await self.refresh()
+        if not self.mode == desired_mode:
+            warnings.warn('TC720: {} is not set in the right mode to use this function. Current mode: {}, set the machine in the {} mode using set_mode({})'.format(self.name, self.mode, desired_mode, desired_mode))
+            return False
+        return True
+
+    #==========================================================================
+    #    Set functions
+    #==========================================================================
+
+    async def set_mode(self, mode, force=False):
+        """Set the mode (0, 1 or 2), see TC720.set_mode()."""
+        if mode not in [0, 1, 2]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(mode)))
+        await self.write_register('3d', self.int_to_hex(mode), force)
+        self.mode = mode
+        self.verboseprint('Mode set to: {}'.format(mode))
+
+    async def set_control_type(self, control_type, force=False):
+        """Set the control type (0, 1 or 2), see TC720.set_control_type()."""
+        if control_type not in [0, 1, 2]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(control_type)))
+        await self.check_mode(0)
+        await self.write_register('3f', self.int_to_hex(control_type), force)
+        self.control_type = control_type
+        self.verboseprint('Control type set to: {}'.format(control_type))
+
+    async def set_temp(self, temperature):
+        """Set the temperature in degree Celsius, see TC720.set_temp()."""
+        await self.check_mode(0)
+        temperature = int(temperature * 100)
+        await self.write_register('1c', self.int_to_hex(temperature))
+        self.verboseprint('Temperature set to: {}C'.format(temperature/100))
+
+    async def set_output(self, output, force=False):
+        """Set the output (-511 to 511), see TC720.set_output()."""
+        await self.check_mode(0)
+        await self.write_register('40', self.int_to_hex(output), force)
+        self.verboseprint('Output set to: {}'.format(output))
+
+    async def set_output_enable(self, enable):
+        """Set the output enable, 0: off, 1: on."""
+        await self.write_register('30', self.int_to_hex(enable))
+        self.verboseprint('Output Enable set to: {}'.format(enable))
+
+    async def set_soak_temp(self, location, temperature):
+        """Set the soak temperature of a location (1-8) in degree Celsius."""
+        self.validate_data(location)
+        await self.check_mode(1)
+        await self.write_register('a' + str(location-1), self.int_to_hex(int(round(temperature * 100))))
+
+    async def set_ramp_time(self, location, time):
+        """Set the ramp time of a location (1-8) in seconds."""
+        self.validate_data(location)
+        await self.check_mode(1)
+        await self.write_register('b' + str(location-1), self.int_to_hex(time))
+
+    async def set_soak_time(self, location, time):
+        """Set the soak time of a location (1-8) in seconds."""
+        self.validate_data(location)
+        if type(time) != int or (1< time > 32768): #half 2**16
+            raise ValueError('Invalid time: "{}", type: "{}. Must be a integer in the range 1-32768.'.format(time, type(time)))
+        await self.check_mode(1)
+        await self.write_register('c' + str(location-1), self.int_to_hex(time))
+
+    async def set_repeats(self, location, repeats):
+        """Set the number of repeats of a location (1-8)."""
+        self.validate_data(location)
+        await self.check_mode(1)
+        await self.write_register('d' + str(location-1), self.int_to_hex(repeats))
+
+    async def set_repeat_location(self, location, repeat_loc):
+        """Set the location (1-8) that is executed after the location (1-8)."""
+        self.validate_data(location)
+        self.validate_data(repeat_loc)
+        await self.check_mode(1)
+        await self.write_register('e' + str(location-1), self.int_to_hex(repeat_loc))
+
+    async def set_sensor1_choice(self, sensor_choice):
+        """Set the sensor type of input 1, see TC720.set_sensor1_choice()."""
+        if sensor_choice not in [0, 1, 2, 3, 4, 5, 6]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1, 2, 3, 4, 5, 6'.format(repr(sensor_choice)))
+        await self.write_register('20', self.int_to_hex(sensor_choice))
+        self.verboseprint('Sensor 1 choice set to: {}'.format(sensor_choice))
+
+    async def set_sensor2_choice(self, sensor_choice):
+        """Set the sensor type of input 2, see TC720.set_sensor2_choice()."""
+        if sensor_choice not in [0, 1, 2, 3, 4, 5, 6]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1, 2, 3, 4, 5, 6'.format(repr(sensor_choice)))
+        await self.write_register('47', self.int_to_hex(sensor_choice))
+        self.verboseprint('Sensor 2 choice set to: {}'.format(sensor_choice))
+
+    async def start_soak(self):
+        """Start the ramp/soak temperature control."""
+        await self.check_mode(1)
+        await self.send_message(self.message_builder('08', '0001'))
+
+    async def idle_soak(self):
+        """Stop the ramp/soak execution."""
+        await self.check_mode(1)
+        await self.send_message(self.message_builder('08', '0000'), write=True)
+
+    async def set_idle(self):
+        """Set in to output control mode with 0 output, always send."""
+        await self.set_mode(0, force=True)
+        await self.set_output(0, force=True)
+        await self.set_control_type(1, force=True)
+
+    async def hold_temp(self, temperature):
+        """Hold a temperature in the PID control type, see TC720.hold_temp()."""
+        if self.state_time == None or time.monotonic() - self.state_time > self.state_ttl:
+            await self.refresh()
+        await self.set_mode(0)
+        await self.set_control_type(0)
+        await self.set_temp(temperature)
+
+    #==========================================================================
+    #    Combined functions
+    #==========================================================================
+
+    async def get_sequence(self, location='all'):
+        """
+        Get the ramp/soak settings as table of strings, see 
+        TC720.get_sequence().
+
+        """
+        seq = np.array([['Loc', 'Temp', 'Ramp time', 'Soak time', 'Repeats', 'Repeat loc']])
+        if location == 'all':
+            location = [1,2,3,4,5,6,7,8]
+        elif type(location) != list:
+            location = [location]
+
+        commands = []
+        for i in location:
+            self.validate_data(i)
+            commands += [code + hex(i + 7)[-1] for field, code in PROGRAM_FIELDS]
+        values = await self.query_many(commands)
+        for n, i in enumerate(location):
+            seq = np.append(seq, [[i] + list(values[5*n : 5*n+5])], axis=0)
+        return seq
+
+    async def read_program(self):
+        """
+        Read the ramp/soak settings of all 8 locations in one batch, see 
+        TC720.read_program().
+
+        """
+        commands = [code + hex(location + 7)[-1] for location in range(1, 9) for field, code in PROGRAM_FIELDS]
+        values = await self.query_many(commands)
+
+        program = np.zeros(8, dtype=PROGRAM_DTYPE)
+        program['location'] = np.arange(1, 9)
+        for n, (field, code) in enumerate(PROGRAM_FIELDS):
+            program[field] = values[n::len(PROGRAM_FIELDS)]
+        return program
+
+    async def write_program(self, program, read_device=True):
+        """
+        Write the ramp/soak settings of one or more locations, only the 
+        changed fields are written. See TC720.write_program().
+
+        """
+        program = np.asarray(program)
+        if program.dtype.names == None:
+            program = np.array([tuple(row) for row in program], dtype=PROGRAM_DTYPE)
+        program = np.atleast_1d(program)
+
+        for row in program:
+            self.validate_data(int(row['location']))
+            self.validate_data(int(row['repeat_location']))
+        await self.check_mode(1)
+
+        if read_device == True:
+            await self.load_registers([code + str(int(row['location']) - 1) for row in program for field, code in PROGRAM_FIELDS])
+
+        for row in program:
+            location = int(row['location'])
+            for field, code in PROGRAM_FIELDS:
+                value = row[field]
+                if field == 'temp':
+                    value = round(value * 100)
+                self.stage_register(code + str(location - 1), self.int_to_hex(int(value)))
+        return await self.sync()
+
+    async def set_single_sequence(self, location, temp=20, ramp_time=60, 
+                                  soak_time=30000, repeats=1, go_to=None):
+        """
+        Set the ramp and temperature settings of one location, see
+        TC720.set_single_sequence().
+
+        """
+        self.validate_data(location)
+        if go_to == None:
+            go_to = location % 8 + 1
+        self.validate_data(go_to)
+        return await self.write_program([(location, temp, ramp_time, soak_time, repeats, go_to)], read_device=False)
+
+    #==========================================================================
+    #   Wait until desired temperature is reached
+    #==========================================================================
+
+    async def wait_temp(self, target_temp, error=1, array_size=5, sd=0.01,
+                        timeout = 5, set_idle = True):
+        """
+        Wait until the target temperature has been reached and is stable. 
+        Other tasks keep running while waiting. See TC720.waitTemp() for the
+        input, `timeout` is in minutes.
+
+        """
+        detector = StabilityDetector(target_temp, error, array_size, sd)
+        start = time.monotonic()
+
+        while True:
+            tic = time.monotonic()
+            cur_temp = await self.get_temp()
+            stable = detector.add(tic, cur_temp)
+            self.verboseprint('Current temperature: ', cur_temp, ' Standard deviation: ', detector.std())
+
+            if stable == True:
+                self.verboseprint('Temperature stable, slope minimal')
+                break
+            if time.monotonic() - start >= timeout * 60:
+                await self.check_error(set_idle=set_idle, raise_exception=True)
+                if set_idle == True:
+                    await self.set_idle()
+                    raise Exception('Temperature could not be reached in {} minutes, check {} system.'.format(timeout, self.name))
+                warnings.warn('Temperature could not be reached in {} minutes, check {} system.'.format(timeout, self.name))
+                break
+
+            # Check every second
+            await asyncio.sleep(max(0, 1 - (time.monotonic() - tic)))
+
+    #==========================================================================
+    #    Check errors
+    #==========================================================================
+
+    async def check_error(self, set_idle = True, raise_exception = True):
+        """
+        Check if there are errors on the system, see TC720.check_error().
+
+        """
+        response = (await self.query_many(['03'], decode=False))[0]
+        response = '{b:0>6}'.format(b = bin(int(response[1:5], 16))[2:])
+
+        #No errors detected
+        if response == '000000':
+            self.verboseprint('No errors on temperature controller: {}'.format(self.name))
+            return [True, 'No errors on temperature controller: {}'.format(self.name)]
+
+        reset='Device NOT set to idle'
+        if set_idle == True:
+            await self.set_idle()
+            reset = 'Device is set to idle.'
+            self.verboseprint(reset)
+
+        error_list = ['Over Current Detected', 'Key press to store value',
+                      'Low Input Voltage', 'Open Input 2', 'Open Input 1', 
+                      'Low Alarm 2', 'High Alarm 2', 'Low Alarm 1', 
+                      'High Alarm 1',]
+        current_errors = [error_list[n] for n,i in enumerate(response) if i == '1']
+        if raise_exception == True:
+            raise Exception('Error(s) on {}: {}. {}'.format(self.name, current_errors, reset))
+        warnings.warn('Error(s) on {}: {}. {}'.format(self.name, current_errors, reset))
+        return [False, 'Error(s) on {}: {}. {}'.format(self.name, current_errors, reset)]
+
+#==============================================================================
+#   Stability
+#==============================================================================
+
+class StabilityDetector():
+    """
+    Streaming test whether a temperature is within `error` of a target and
+    stable. The mean, variance and slope over the last `window` samples are
+    updated with Welford's method when a sample enters or leaves the window,
+    so a sample costs the same for any window size. Times are taken relative
+    to the oldest sample and the sums are recomputed from the window every 
+    10 windows, so rounding errors do not add up in long runs. The samples can come
+    from any source: a TC720, the samples of a controller, a log file or a
+    TC720_simulation. The detector does not read from a device itself.
+    Input:
+    `target`(float): Temperature to reach in Celsius. None to only test if
+        the temperature is stable.
+    `error`(float): Degree Celsius error allowed between target and the
+        last temperature. Default = 1
+    `window`(int): Number of samples that need to be stable. Default = 5
+    `sd`(float): The temperature is stable when the standard deviation of
+        the window is below `sd`. Default = 0.01
+    `slope`(float): If given, the absolute slope of the window, in degree
+        Celsius per second, also needs to be below `slope`. Default = None
+    `callback`(function): Called as callback(t, temperature) with the
+        sample at which the temperature became stable. Default = None
+    When the temperature becomes stable `event` (threading.Event) is set.
+
+    """
+    def __init__(self, target = None, error = 1, window = 5, sd = 0.01, 
+                 slope = None, callback = None):
+        self.error = error
+        self.sd = sd
+        self.max_slope = slope
+        self.callback = callback
+        self.samples = deque(maxlen = window)
+        self.event = threading.Event()
+        self.reset(target)
+
+    def reset(self, target = None):
+        """
+        Empty the window and clear the event, for instance after a change of 
+        the target.
         Input:
-        `command`(str): Command character with length 2, encoded in hexadecimal
-            ASCII characters.
-        `value`(str): Value characters with length 4, encoded in hexadecimal
-            ASCII characters.
-        Returns message as list of 10 individual bits.     
-        
-        Structure of message: (stx)CCDDDDSS(etx)
-            (stx): Start text character = '*'
-            CC: Command, 2 bits
-            DDDD: Value, 4 bits
-            SS: Checksum, 2 bits
-            (etx): End of text character = '\r'    
-        
+        `target`(float): New target temperature. None to keep the target.
+
+        """
+        if target != None or not hasattr(self, 'target'):
+            self.target = target
+        self.samples.clear()
+        self.n = 0
+        self.updates = 0
+        self.t_ref = 0.0
+        self.mean_t = 0.0
+        self.mean = 0.0
+        self.m2_t = 0.0
+        self.m2 = 0.0
+        self.c_t = 0.0
+        self.stable = False
+        self.stable_since = None
+        self.event.clear()
+
+    def add(self, t, temperature):
+        """
+        Add one sample.
+        Input:
+        `t`(float): Time of the sample in seconds.
+        `temperature`(float): Temperature in Celsius.
+        Returns:
+        True if the temperature is within range and stable.
+
+        """
+        if len(self.samples) == self.samples.maxlen:
+            self.remove(*self.samples[0])
+        if self.n == 0:
+            self.t_ref = t
+        self.samples.append((t, temperature))
+        self.n = self.n + 1
+        self.updates = self.updates + 1
+        x = t - self.t_ref
+        dt = x - self.mean_t
+        self.mean_t = self.mean_t + dt / self.n
+        dT = temperature - self.mean
+        self.mean = self.mean + dT / self.n
+        self.m2_t = self.m2_t + dt * (x - self.mean_t)
+        self.m2 = self.m2 + dT * (temperature - self.mean)
+        self.c_t = self.c_t + dt * (temperature - self.mean)
+        if self.updates >= 10 * self.samples.maxlen:
+            self.recompute()
+
+        stable = self.check(temperature)
+        if stable == True and self.stable == False:
+            self.stable_since = t
+            self.event.set()
+            if self.callback != None:
+                self.callback(t, temperature)
+        self.stable = stable
+        return stable
+
+    def remove(self, t, temperature):
+        # takes the oldest sample out of the sums, it stays in self.samples
+        self.n = self.n - 1
+        if self.n == 0:
+            self.mean_t = self.mean = self.m2_t = self.m2 = self.c_t = 0.0
+            return
+        x = t - self.t_ref
+        dt = x - self.mean_t
+        self.mean_t = self.mean_t - dt / self.n
+        dT = temperature - self.mean
+        self.mean = self.mean - dT / self.n
+        self.m2_t = max(self.m2_t - dt * (x - self.mean_t), 0)
+        self.m2 = max(self.m2 - dT * (temperature - self.mean), 0)
+        self.c_t = self.c_t - dt * (temperature - self.mean)
+
+    def recompute(self):
+        # sums of the samples in the window, relative to the oldest sample
+        t, temperature = np.array(self.samples, dtype=float).T
+        self.t_ref = t[0]
+        t = t - self.t_ref
+        self.n = len(t)
+        self.mean_t = t.mean()
+        self.mean = temperature.mean()
+        self.m2_t = ((t - self.mean_t)**2).sum()
+        self.m2 = ((temperature - self.mean)**2).sum()
+        self.c_t = ((t - self.mean_t) * (temperature - self.mean)).sum()
+        self.updates = 0
+
+    def check(self, temperature):
+        if len(self.samples) < self.samples.maxlen:
+            return False
+        if self.target != None and not (self.target - self.error) < temperature < (self.target + self.error):
+            return False
+        if self.std() >= self.sd:
+            return False
+        if self.max_slope != None and abs(self.slope()) >= self.max_slope:
+            return False
+        return True
+
+    def variance(self):
         """
-        message = ['*', '0', '0', '0', '0', '0', '0', '0', '0', '\r']
-        
-        #Command
-        if type(command) != str:
-            try:
-                command = str(command)
-            except Exception:
-                raise ValueError('Invalid command input: "{}", Type:"{}". Input should be a string of length 2'.format(command, type(command)))
-        if len(command) != 2:
-            raise ValueError('Invalid command input: "{}", Type:"{}". Input should be a string of length 2'.format(command, type(command)))
-        
-        message[1:2] = command[0], command[1]
-        
-        #Make string message
-        if type(value) != str:
-            try:
-                value = str(value)
-            except Exception:
-                raise ValueError('Invalid message input: "{}", Type:"{}". Input should be a string of length 4'.format(value, type(value)))
-        if len(value) != 4:
-            raise ValueError('Invalid message input: "{}", Type:"{}". Input should be a string of length 4'.format(value, type(value)))
-        
-        message[3:8] = value[0], value[1], value[2], value[3]
-        
-        #Checksum
-        checksum = self.make_checksum(message)
-        message[7:9] = checksum[0], checksum[1]
-        
-        return message
+        Returns the variance of the temperatures in the window.
+
+        """
+        return self.m2 / self.n if self.n > 0 else 0.0
+
+    def std(self):
+        """
+        Returns the standard deviation of the temperatures in the window.
+
+        """
+        return self.variance()**0.5
+
+    def slope(self):
+        """
+        Returns the least squares slope of the window in degree Celsius per 
+        second, 0 if there are less than two samples.
+
+        """
+        return self.c_t / self.m2_t if self.m2_t > 0 else 0.0
+
+    def feed(self, times, temperatures):
+        """
+        Add many samples, for instance the columns of a log file.
+        Input:
+        `times`, `temperatures`(array): Time and temperature of the samples.
+        Returns:
+        Time at which the temperature became stable, or None.
+
+        """
+        for t, temperature in zip(times, temperatures):
+            if self.add(t, temperature) == True:
+                return self.stable_since
+        return None
+
+#==============================================================================
+#   Simulation
+#==============================================================================
+
+class VirtualClock():
+    """
+    Clock that only advances when sleep() is called, so simulated hours take
+    milliseconds. It has the time() and sleep() functions of the time module,
+    which is the default clock of TC720_simulation. Meant for one thread.
+
+    """
+    def __init__(self, start = 0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now = self.now + max(seconds, 0)
+
+class ThermalModel():
+    """
+    Second order thermal model of a TC-720 setup: a Peltier plate with
+    sensor 1 and a sample (or heat sink) with sensor 2. The plate is coupled
+    to the sample and both lose heat to the ambient.
+    Input:
+    `ambient`(float): Ambient temperature in degree Celsius. Default = 22
+    `max_power`(float): Heat pumped into the plate at 100% output, in Watt.
+        Default = 40
+    `plate_capacity`, `sample_capacity`(float): Heat capacity in J/K.
+        Default = 40, 100
+    `plate_sample_resistance`, `plate_ambient_resistance`,
+        `sample_ambient_resistance`(float): Thermal resistance in K/W.
+        Default = 0.5, 2, 4
+
+    """
+    def __init__(self, ambient = 22, max_power = 40, plate_capacity = 40, 
+                 sample_capacity = 100, plate_sample_resistance = 0.5, 
+                 plate_ambient_resistance = 2, sample_ambient_resistance = 4):
+        self.ambient = ambient
+        self.max_power = max_power
+        self.plate_capacity = plate_capacity
+        self.sample_capacity = sample_capacity
+        self.plate_sample_resistance = plate_sample_resistance
+        self.plate_ambient_resistance = plate_ambient_resistance
+        self.sample_ambient_resistance = sample_ambient_resistance
+        self.temp1 = ambient
+        self.temp2 = ambient
+
+    def step(self, output, dt):
+        """
+        Advance the temperatures `dt` seconds with `output` in the range -1 
+        to 1.
+
+        """
+        plate_to_sample = (self.temp1 - self.temp2) / self.plate_sample_resistance
+        plate_to_ambient = (self.temp1 - self.ambient) / self.plate_ambient_resistance
+        sample_to_ambient = (self.temp2 - self.ambient) / self.sample_ambient_resistance
+        self.temp1 = self.temp1 + dt * (output * self.max_power - plate_to_sample - plate_to_ambient) / self.plate_capacity
+        self.temp2 = self.temp2 + dt * (plate_to_sample - sample_to_ambient) / self.sample_capacity
+
+class TC720_simulation(TC720Protocol):
+    """
+    Simulated TC-720 with the functions of the TC720 class. The device 
+    drives a ThermalModel with its PID control, the manual output or the 
+    ramp/soak program, so the temperatures respond like a real setup.
+
+    """
+    #Seconds per simulation step.
+    dt = 0.1
+
+    def __init__(self, address = None, serial_number = None, name = 'TC-720', default_temp = None, verbose = False,
+                 clock = time, model = None, latency = 0.01, noise = 0.01, pid = (0.3, 0.02, 0)):
+        """
+        Input:
+        `address`, `serial_number`: Not used.
+        `name`, `default_temp`, `verbose`: See TC720.
+        `clock`: Object with the time() and sleep() functions of the time 
+            module. Use a VirtualClock to run faster than real time. 
+            Default = time
+        `model`(ThermalModel): Thermal model of the setup. 
+            Default = ThermalModel()
+        `latency`(float): Seconds every exchange with the device takes.
+            Default = 0.01
+        `noise`(float): Standard deviation of the temperature readings in 
+            degree Celsius. Default = 0.01
+        `pid`(tuple): Proportional (1/C), integral (1/(C*s)) and derivative 
+            (s/C) gain of the temperature control, for an output in the
+            range -1 to 1. Default = (0.3, 0.02, 0)
+
+        """
+        # the stored mode and control type are the settings of the device below
+        self.init_state(name, verbose, 0)
+        self.clock = clock
+        self.model = ThermalModel() if model == None else model
+        self.latency = latency
+        self.noise = noise
+        self.kp, self.ki, self.kd = pid
+        self.random = np.random.default_rng()
+        # the reading and writing threads of the controllers share the device
+        self.lock = threading.RLock()
+
+        # settings of the device
+        self.mode = 0
+        self.control_type = 0
+        self.set_temperature = 20.0
+        self.set_output_level = 0.0
+        self.output_enable = 1
+        self.program = np.zeros(8, dtype=PROGRAM_DTYPE)
+        self.program['location'] = np.arange(1, 9)
+        self.program['temp'] = 20
+        self.program['ramp_time'] = 60
+        self.program['soak_time'] = 60
+        self.program['repeats'] = 1
+        self.program['repeat_location'] = np.roll(np.arange(1, 9), -1)
+
+        # state of the simulation
+        self.time = self.clock.time()
+        self.output = 0.0
+        self.integral = 0.0
+        self.last_error = None
+        # ramp/soak program, see start_soak()
+        self.running = False
+        self.location = 1
+        self.repeat_count = 0
+        self.ramping = False
+        self.stage_time = 0.0
+        self.ramp_from = self.set_temperature
+        self.setpoint = self.set_temperature
+
+        if default_temp != None:
+            self.set_temp(default_temp)
+            self.set_mode(0)
+            self.set_control_type(0)
+
+    #==========================================================================
+    #    Simulation
+    #==========================================================================
+
+    def advance(self):
+        """
+        Run the simulation up to the current time of the clock.
+
+        """
+        with self.lock:
+            now = self.clock.time()
+            while now - self.time >= self.dt:
+                self.step(self.dt)
+                self.time = self.time + self.dt
+
+    def step(self, dt):
+        """
+        One simulation step of `dt` seconds: the control of the device 
+        followed by the thermal model.
+
+        """
+        if self.mode == 1 and self.running:
+            self.step_program(dt)
+        if self.output_enable == 0:
+            output = 0.0
+        elif self.mode == 0 and self.control_type == 1:
+            output = self.set_output_level
+        elif self.mode == 0 and self.control_type == 0:
+            output = self.pid(self.set_temperature, dt)
+        elif self.mode == 1 and self.running:
+            output = self.pid(self.setpoint, dt)
+        else:
+            output = 0.0
+        self.output = output
+        self.model.step(output, dt)
+
+    def pid(self, setpoint, dt):
+        """
+        Output of the PID control for the temperature of sensor 1.
+
+        """
+        error = setpoint - self.model.temp1
+        derivative = 0 if self.last_error == None else (error - self.last_error) / dt
+        self.last_error = error
+        output = self.kp * error + self.ki * (self.integral + error * dt) + self.kd * derivative
+        #Only integrate while the output is not saturated (anti-windup)
+        if -1 < output < 1:
+            self.integral = self.integral + error * dt
+        return min(max(output, -1), 1)
+
+    def reset_pid(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def step_program(self, dt):
+        """
+        Move the setpoint along the ramp/soak program.
+
+        """
+        row = self.program[self.location - 1]
+        self.stage_time = self.stage_time + dt
+        if self.ramping:
+            if self.stage_time >= row['ramp_time']:
+                self.ramping = False
+                self.stage_time = 0.0
+                self.setpoint = float(row['temp'])
+            else:
+                self.setpoint = self.ramp_from + (row['temp'] - self.ramp_from) * self.stage_time / row['ramp_time']
+        elif self.stage_time >= row['soak_time']:
+            #Repeat the location, or go to the repeat location
+            self.repeat_count = self.repeat_count + 1
+            if self.repeat_count >= row['repeats']:
+                self.location = int(row['repeat_location'])
+                self.repeat_count = 0
+            self.start_location()
+
+    def start_program(self):
+        self.running = True
+        self.location = 1
+        self.repeat_count = 0
+        self.setpoint = self.model.temp1
+        self.start_location()
+        self.reset_pid()
+
+    def start_location(self):
+        self.ramping = True
+        self.stage_time = 0.0
+        self.ramp_from = self.setpoint
+
+    def transaction(self):
+        """
+        Every exchange with the device takes `latency` seconds. The
+        simulation is brought up to date before the device is read or 
+        changed.
+
+        """
+        self.clock.sleep(self.latency)
+        self.advance()
+
+    def reading(self, temperature):
+        #Temperature reading with noise, in 1/100 degree like the device
+        return round(temperature + self.noise * self.random.standard_normal(), 2)
+
+    def read_value(self, command):
+        """
+        Value of a read command, as the TC720 class returns it.
+
+        """
+        if command == '01':
+            return self.reading(self.model.temp1)
+        if command == '04':
+            return self.reading(self.model.temp2)
+        if command == '02':
+            return round(self.output * 511) / 511.0
+        if command == '50':
+            return self.set_temperature
+        if command == '74':
+            return self.set_output_level
+        if command == '71':
+            return self.mode
+        if command == '73':
+            return self.control_type
+        if command == '09':
+            #Bits: sequence running, soak stage, ramp stage
+            if self.running == False:
+                return 0
+            return 5 if self.ramping else 6
+        if command[0] in 'abcde' and command[1] in '89abcdef':
+            field = [field for field, code in PROGRAM_FIELDS if code == command[0]][0]
+            value = self.program[int(command[1], 16) - 8][field]
+            return float(value) if field == 'temp' else int(value)
+        return 0
+
+    def read(self, command):
+        with self.lock:
+            self.transaction()
+            return self.read_value(command)
+
+    #==========================================================================
+    #    Functions for sending and reading messages
+    #==========================================================================
 
     def send_message(self, message, write=False):
         pass
@@ -1230,17 +2810,20 @@ class TC720_simulation():
     def read_message(self, timeout=1, detect_error=True):
         return None
 
+    def query_many(self, commands, retries=5):
+        with self.lock:
+            self.transaction()
+            return tuple([self.read_value(c) for c in commands])
+
     #==========================================================================
     #    Read functions
     #==========================================================================
 
     def get_temp(self):
-        time.sleep(0.01)
-        return np.random.rand()
+        return self.read('01')
 
     def get_temp2(self):
-        time.sleep(0.01)
-        return np.random.rand()
+        return self.read('04')
 
     def get_mode(self):
         """
@@ -1251,7 +2834,7 @@ class TC720_simulation():
             2 = Proportional+Dead Band
         
         """
-        return 0
+        return self.read('71')
 
     def get_control_type(self):
         """
@@ -1264,52 +2847,77 @@ class TC720_simulation():
             supply.
 
         """
-        return 0
+        return self.read('73')
 
     def get_set_temp(self):
-        time.sleep(0.01)
-        return np.random.rand()
+        return self.read('50')
 
     def get_output(self):
-        time.sleep(0.01)
-        return np.random.rand()
+        return self.read('02')
 
     def get_set_output(self):
-        return np.random.rand()
+        return self.read('74')
 
     def get_ramp_soak_status(self):
-        return np.random.rand()
+        status = self.read('09')
+        if status == 0:
+            return 'No sequence running'
+        status_list = ['Sequence Running', 'Soak stage', 'Ramp stage']
+        return [status_list[n] for n,i in enumerate('{0:03b}'.format(status)) if i == '1']
             
     def get_soak_temp(self, location):
-        return np.random.rand()
+        self.validate_data(location)
+        return self.read('a' + hex(location + 7)[-1])
 
     def get_ramp_time(self, location):
-        return np.random.rand()
+        self.validate_data(location)
+        return self.read('b' + hex(location + 7)[-1])
 
     def get_soak_time(self, location):
-        return np.random.rand()
+        self.validate_data(location)
+        return self.read('c' + hex(location + 7)[-1])
 
     def get_repeats(self, location):
-        return np.random.rand()
+        self.validate_data(location)
+        return self.read('d' + hex(location + 7)[-1])
 
     def get_repeat_location(self, location):
-        return np.random.rand()
+        self.validate_data(location)
+        return self.read('e' + hex(location + 7)[-1])
 
-    def validate_data(self, input):
-        pass
+    def refresh(self):
+        return self.query_many(['71', '73'])
 
     def check_mode(self, desired_mode):
+        if desired_mode not in [0, 1, 2]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(desired_mode)))
+        if self.mode != desired_mode:
+            warnings.warn('TC720: {} is not set in the right mode to use this function. Current mode: {}, set the machine in the {} mode using set_mode({})'.format(self.name, self.mode, desired_mode, desired_mode))
+            return False
         return True
 
     #==========================================================================
     #    Set functions for the operation modes
     #==========================================================================
 
-    def set_mode(self, mode):
-        pass
+    def set_mode(self, mode, force=False):
+        if mode not in [0, 1, 2]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(mode)))
+        with self.lock:
+            self.transaction()
+            self.mode = mode
+            self.reset_pid()
+        self.verboseprint('Mode set to: {}'.format(mode))
 
-    def set_control_type(self, control_type):
-        pass
+    def set_control_type(self, control_type, force=False):
+        if control_type not in [0, 1, 2]:
+            raise ValueError('Invalid input: {}, should be integer 0, 1 or 2'.format(repr(control_type)))
+        self.check_mode(0)
+        with self.lock:
+            self.transaction()
+            self.control_type = control_type
+            self.reset_pid()
+        self.verboseprint('Control type set to: {}'.format(control_type))
 
     #---------------------------------------------------------------------------
     #    Set functions for Normal set mode
@@ -1318,13 +2926,24 @@ class TC720_simulation():
     #---------------------------------------------------------------------------
 
     def set_temp(self, temperature):
-        pass
+        self.check_mode(0)
+        with self.lock:
+            self.transaction()
+            self.set_temperature = int(temperature * 100) / 100
+        self.verboseprint('Temperature set to: {}C'.format(self.set_temperature))
 
-    def set_output(self, output):
-        pass
+    def set_output(self, output, force=False):
+        self.check_mode(0)
+        with self.lock:
+            self.transaction()
+            self.set_output_level = int(output) / 511.0
+        self.verboseprint('Output set to: {}'.format(output))
 
     def set_output_enable(self,enable):
-        pass
+        with self.lock:
+            self.transaction()
+            self.output_enable = enable
+        self.verboseprint('Output Enable set to: {}'.format(enable))
 
 
     #---------------------------------------------------------------------------
@@ -1332,26 +2951,32 @@ class TC720_simulation():
     #    Functions to set the ramp/soak sequence.
     #---------------------------------------------------------------------------
 
+    def set_program_field(self, location, field, value):
+        self.validate_data(location)
+        with self.lock:
+            self.transaction()
+            self.program[location - 1][field] = value
+
     def set_soak_temp(self, location, temperature):
-        pass
+        self.set_program_field(location, 'temp', int(temperature * 100) / 100)
 
     def set_ramp_time(self, location, time):
-        pass
+        self.set_program_field(location, 'ramp_time', time)
 
     def set_soak_time(self, location, time):
-        pass
+        self.set_program_field(location, 'soak_time', time)
 
     def set_repeats(self, location, repeats):
-        pass
+        self.set_program_field(location, 'repeats', repeats)
 
     def set_repeat_location(self, location, repeat_loc):
-        pass
+        self.set_program_field(location, 'repeat_location', repeat_loc)
 
     def set_sensor1_choice(self, sensor_choice):
-        pass
+        self.transaction()
 
     def set_sensor2_choice(self, sensor_choice):
-        pass
+        self.transaction()
 
 
     #--------------------------------------------------------------------------
@@ -1359,37 +2984,77 @@ class TC720_simulation():
     #--------------------------------------------------------------------------
 
     def start_soak(self):
-        pass
+        """
+        Start the ramp/soak program at location 1. The setpoint ramps from 
+        the current temperature to the soak temperature in the ramp time,
+        holds it for the soak time and this is done "repeats" times, after 
+        which the program continues at the repeat location. 
+
+        """
+        self.check_mode(1)
+        with self.lock:
+            self.transaction()
+            self.start_program()
 
     def idle_soak(self):
-        pass
+        self.check_mode(1)
+        with self.lock:
+            self.transaction()
+            self.running = False
 
     def set_idle(self):
-        pass
+        self.set_mode(0)
+        self.set_output(0)
+        self.set_control_type(1)
+
+    def hold_temp(self, temperature):
+        self.set_mode(0)
+        self.set_control_type(0)
+        self.set_temp(temperature)
 
     #==========================================================================
     #    Combined functions
     #    These are the most useful to the user
     #==========================================================================
 
-    def get_sequence(self, location='all'):
-        pass
+    # these functions of the TC720 only use the functions above
+    get_sequence = TC720.get_sequence
+    read_program = TC720.read_program
+    set_single_sequence = TC720.set_single_sequence
+
+    def write_program(self, program, read_device=True):
+        program = np.asarray(program)
+        if program.dtype.names == None:
+            program = np.array([tuple(row) for row in program], dtype=PROGRAM_DTYPE)
+        program = np.atleast_1d(program)
+        for row in program:
+            self.validate_data(int(row['location']))
+            self.validate_data(int(row['repeat_location']))
+        self.check_mode(1)
+
+        written = 0
+        with self.lock:
+            self.transaction()
+            for row in program:
+                n = int(row['location']) - 1
+                for field, code in PROGRAM_FIELDS:
+                    value = round(row[field] * 100) / 100 if field == 'temp' else int(row[field])
+                    if self.program[n][field] != value:
+                        self.program[n][field] = value
+                        written = written + 1
+        return written
 
-    def set_single_sequence(self, location, temp=20, ramp_time=60, 
-                            soak_time=30000, repeats=1, go_to=None):
-        pass
-     
     #==========================================================================
     #   Wait until desired temperature is reached
     #==========================================================================
 
-    def waitTemp(self, target_temp, error=1, array_size=5, sd=0.01, 
-                timeout = 5, set_idle = True):
-        pass
+    waitTemp = TC720.waitTemp
 
     #==========================================================================
     #    Check errors
     #==========================================================================
 
     def check_error(self, set_idle = True, raise_exception = True):
-        return True
\ No newline at end of file
+        self.transaction()
+        self.verboseprint('No errors on temperature controller: {}'.format(self.name))
+        return [True, 'No errors on temperature controller: {}'.format(self.name)]
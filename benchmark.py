@@ -0,0 +1,335 @@
+################################################################################
+#Latency benchmark for the TC-720 serial protocol.
+#
+#Runs the TC720 class against the emulated device of emulator.py, so no
+#hardware is needed (Linux/macOS only). Every command is timed with the old
+#transmit path (one character per write with a 5 ms pause) and with the frame
+#level transmit path (the whole frame in one write).
+#
+#The --fleet option measures how the aggregate sample rate of the 
+#FleetController scales with the number of simulated devices.
+#The --log option compares size and parse time of the text log and the
+#binary log format (logs.py), and times opening a 7 day log at 10 Hz and
+#reading one hour of it with logs.LogReader.
+#
+#The --protocol option runs the protocol suite against the emulated device:
+#p50/p95/p99 latency of every getter and setter, transactions per second of
+#mixed read/write workloads, the overhead of retries after checksum errors
+#and the time of get_sequence('all'). With --json the results are written to
+#a file, to compare them between commits.
+#
+#Usage:
+#python benchmark.py --repeats 20
+#python benchmark.py --protocol --json results.json
+#python benchmark.py --fleet
+#python benchmark.py --log --samples 1000000
+################################################################################
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import TC720
+import emulator
+import logs
+
+#_______________________________________________________________________________
+#   BENCHMARK
+
+#Commands with the arguments of the calls. Setters alternate between two 
+#values, otherwise the writes are skipped because the device already holds 
+#the value.
+COMMANDS = [
+    ('get_temp', [()]),
+    ('get_temp2', [()]),
+    ('get_output', [()]),
+    ('get_mode', [()]),
+    ('set_mode', [(1,), (0,)]),
+    ('set_temp', [(25.5,), (25.0,)]),
+    ('set_output_enable', [(1,), (0,)]),
+    ]
+
+def time_commands(device, repeats):
+    """
+    Time every command in COMMANDS.
+    Returns a dictionary with per command the median time in ms spent in
+    device.write_frame() and the median latency in ms of the full command.
+
+    """
+    #Time the transmit path separately from the full command.
+    write_frame = device.write_frame
+    transmit = []
+    def timed_write_frame(frame):
+        tic = time.perf_counter()
+        write_frame(frame)
+        transmit.append(time.perf_counter() - tic)
+    device.write_frame = timed_write_frame
+
+    results = {}
+    for name, calls in COMMANDS:
+        method = getattr(device, name)
+        durations = []
+        del transmit[:]
+        for n in range(repeats):
+            tic = time.perf_counter()
+            method(*calls[n % len(calls)])
+            durations.append(time.perf_counter() - tic)
+        results[name] = (1000 * np.median(transmit), 1000 * np.median(durations))
+    device.ser.close()
+    return results
+
+#Getters and setters of the protocol suite, with the arguments of the calls.
+#Setters alternate between two values, otherwise the writes are skipped
+#because the device already holds the value.
+PROTOCOL_GETTERS = [
+    ('get_temp', [()]),
+    ('get_temp2', [()]),
+    ('get_output', [()]),
+    ('get_set_temp', [()]),
+    ('get_set_output', [()]),
+    ('get_mode', [()]),
+    ('get_control_type', [()]),
+    ('get_ramp_soak_status', [()]),
+    ('get_soak_temp', [(1,)]),
+    ('get_ramp_time', [(1,)]),
+    ]
+PROTOCOL_SETTERS = [
+    ('set_temp', [(25.0,), (25.5,)]),
+    ('set_output_enable', [(0,), (1,)]),
+    ('set_sensor1_choice', [(1,), (2,)]),
+    ]
+
+#Fraction of reads in the mixed workloads.
+WORKLOADS = [('read only', 1.0), ('90% read', 0.9), ('50% read', 0.5)]
+
+#Probability of a checksum error per reply in the retry test.
+ERROR_RATES = [0.0, 0.01, 0.05, 0.2]
+
+def percentiles(durations):
+    p50, p95, p99 = 1000 * np.percentile(durations, [50, 95, 99])
+    return {'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+def protocol_suite(repeats, duration):
+    """
+    Run the protocol suite against an emulated device, see the top of this 
+    file.
+    Returns a dictionary with the results.
+
+    """
+    device = emulator.EmulatedTC720(seed=0)
+    tc = TC720.TC720(device.address)
+    tc.set_mode(0)
+    tc.set_control_type(0)
+    results = {'commands': {}, 'workloads': {}, 'retries': {}}
+    try:
+        #Latency per command
+        for name, calls in PROTOCOL_GETTERS + PROTOCOL_SETTERS:
+            method = getattr(tc, name)
+            durations = []
+            for n in range(repeats):
+                tic = time.perf_counter()
+                method(*calls[n % len(calls)])
+                durations.append(time.perf_counter() - tic)
+            results['commands'][name] = percentiles(durations)
+
+        #Sustained transactions per second
+        rng = np.random.default_rng(0)
+        for name, read_fraction in WORKLOADS:
+            transactions = 0
+            writes = 0
+            tic = time.perf_counter()
+            while time.perf_counter() - tic < duration:
+                if rng.random() < read_fraction:
+                    tc.query_many(['01'])
+                else:
+                    #Every write differs from the last one, so none is skipped
+                    writes = writes + 1
+                    tc.set_temp(25 + writes % 2)
+                transactions = transactions + 1
+            results['workloads'][name] = {'transactions_per_s': transactions / (time.perf_counter() - tic)}
+
+        #Overhead of retries after checksum errors, three reads per call
+        for rate in ERROR_RATES:
+            device.fault_rates['checksum'] = rate
+            durations = []
+            for n in range(repeats):
+                tic = time.perf_counter()
+                tc.query_many(['01', '04', '02'])
+                durations.append(time.perf_counter() - tic)
+            results['retries'][str(rate)] = percentiles(durations)
+            results['retries'][str(rate)]['overhead'] = np.median(durations) / (results['retries']['0.0']['p50_ms'] / 1000)
+        device.fault_rates['checksum'] = 0.0
+
+        #Full ramp/soak table
+        durations = []
+        for n in range(repeats):
+            tic = time.perf_counter()
+            tc.get_sequence('all')
+            durations.append(time.perf_counter() - tic)
+        results['get_sequence_all'] = percentiles(durations)
+    finally:
+        tc.ser.close()
+        device.close()
+    return results
+
+def environment():
+    """
+    Returns a dictionary with the commit and Python version, stored with
+    the results.
+
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()}
+
+def fleet_scaling(device_counts, duration):
+    """
+    Poll simulated devices as fast as possible with the FleetController.
+    Returns a dictionary with the aggregate samples per second for every 
+    number of devices.
+
+    """
+    import controllers
+
+    results = {}
+    for count in device_counts:
+        fleet = controllers.FleetController(['SIM{}'.format(n) for n in range(count)], sample_rate=0, is_simulation=True)
+        fleet.start()
+        time.sleep(duration)
+        fleet.close()
+        results[count] = fleet.number_of_samples / duration
+    return results
+
+def log_formats(number_of_samples):
+    """
+    Write the same samples as text log and as binary log and read them back.
+    Returns a dictionary with per format the size in bytes and the parse 
+    time in seconds.
+
+    """
+    #Samples like the controller makes them: 10 Hz, 2 decimal temperatures.
+    t = time.time() + np.arange(number_of_samples) / 10
+    set_temperature = np.full(number_of_samples, 37.0)
+    temperature1 = np.round(37 + np.random.randn(number_of_samples), 2)
+    temperature2 = np.round(25 + np.random.randn(number_of_samples), 2)
+    output = np.random.randint(-511, 512, number_of_samples) / 511.0
+    samples = np.column_stack((t, set_temperature, temperature1, temperature2, output))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, 'log.csv')
+        binary_path = os.path.join(directory, 'log.tc720log')
+
+        writer = logs.BinaryLogWriter(binary_path)
+        writer.write_many(samples)
+        writer.close()
+        logs.export_text(binary_path, text_path)
+
+        tic = time.perf_counter()
+        np.loadtxt(text_path, delimiter='\t')
+        results['text'] = (os.path.getsize(text_path), time.perf_counter() - tic)
+
+        tic = time.perf_counter()
+        logs.open_log(binary_path, mmap=False)
+        results['binary'] = (os.path.getsize(binary_path), time.perf_counter() - tic)
+
+        tic = time.perf_counter()
+        np.asarray(logs.open_log(binary_path)['temperature1']).sum()
+        results['binary, memory mapped'] = (os.path.getsize(binary_path), time.perf_counter() - tic)
+    return results
+
+def log_review(days=7, sample_rate=10):
+    """
+    Write a log of `days` days and read random one hour windows from it.
+    Returns the time in seconds to open the log and the median time to read
+    one window with logs.LogReader.
+
+    """
+    number_of_samples = int(days * 24 * 3600 * sample_rate)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.tc720log')
+        writer = logs.BinaryLogWriter(path)
+        t0 = time.time()
+        for start in range(0, number_of_samples, 1000000):
+            t = t0 + np.arange(start, min(start + 1000000, number_of_samples)) / sample_rate
+            writer.write_many(np.column_stack((t, np.full(len(t), 37.0), t % 10, t % 5, t % 1)))
+        writer.close()
+
+        tic = time.perf_counter()
+        reader = logs.LogReader(path)
+        open_time = time.perf_counter() - tic
+
+        durations = []
+        for hour in np.random.randint(0, days * 24, 20):
+            tic = time.perf_counter()
+            window = reader.window_columns(t0 + hour * 3600, t0 + (hour + 1) * 3600)
+            window[2].max()
+            durations.append(time.perf_counter() - tic)
+    return open_time, np.median(durations)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=20, help='Number of times each command is timed.')
+    parser.add_argument('--fleet', action='store_true', help='Measure the FleetController scaling with simulated devices.')
+    parser.add_argument('--duration', type=float, default=2, help='Seconds per fleet size.')
+    parser.add_argument('--log', action='store_true', help='Compare the text and binary log formats.')
+    parser.add_argument('--samples', type=int, default=1000000, help='Number of log samples.')
+    parser.add_argument('--protocol', action='store_true', help='Run the protocol suite against the emulated device.')
+    parser.add_argument('--json', help='Write the protocol suite results to this file.')
+    args = parser.parse_args()
+
+    if args.protocol:
+        results = protocol_suite(args.repeats, args.duration)
+        print('{:24}|{:>10} |{:>10} |{:>10}'.format('Command', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+        for name, result in list(results['commands'].items()) + [('get_sequence all', results['get_sequence_all'])]:
+            print('{:24}|{:10.2f} |{:10.2f} |{:10.2f}'.format(name, result['p50_ms'], result['p95_ms'], result['p99_ms']))
+        print('{:24}|{:>10}'.format('Workload', 'Trans./s'))
+        for name, result in results['workloads'].items():
+            print('{:24}|{:10.0f}'.format(name, result['transactions_per_s']))
+        print('{:24}|{:>10} |{:>10} |{:>10}'.format('Checksum error rate', 'p50 (ms)', 'p99 (ms)', 'Overhead'))
+        for rate, result in results['retries'].items():
+            print('{:24}|{:10.2f} |{:10.2f} |{:10.2f}'.format(rate, result['p50_ms'], result['p99_ms'], result['overhead']))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'environment': environment(), 'results': results}, f, indent=2)
+        return
+
+    if args.log:
+        results = log_formats(args.samples)
+        print('{} samples'.format(args.samples))
+        print('{:24}|{:>12} |{:>12}'.format('Format', 'Size (MB)', 'Parse (s)'))
+        for name, (size, duration) in results.items():
+            print('{:24}|{:12.1f} |{:12.3f}'.format(name, size / 1e6, duration))
+        open_time, window_time = log_review()
+        print('7 days at 10 Hz: open {:.1f} ms, read one hour {:.1f} ms'.format(1000 * open_time, 1000 * window_time))
+        return
+
+    if args.fleet:
+        results = fleet_scaling([1, 2, 4, 8, 16], args.duration)
+        print('{:10}|{:>16} |{:>10}'.format('Devices', 'Samples/s', 'Speed-up'))
+        for count, rate in results.items():
+            print('{:10}|{:16.1f} |{:10.2f}'.format(count, rate, rate / results[1]))
+        return
+
+    device = emulator.EmulatedTC720()
+    try:
+        before = time_commands(TC720.TC720(device.address, inter_byte_delay=0.005), args.repeats)
+        after = time_commands(TC720.TC720(device.address), args.repeats)
+    finally:
+        device.close()
+
+    print('Median time in ms, transmit = time spent writing one frame.')
+    print('{:20}|{:>18} |{:>18} |{:>18} |{:>18}'.format('Command', 'Transmit before', 'Transmit after', 'Command before', 'Command after'))
+    for name, calls in COMMANDS:
+        print('{:20}|{:18.2f} |{:18.2f} |{:18.1f} |{:18.1f}'.format(name, before[name][0], after[name][0], before[name][1], after[name][1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+
+class RingBuffer():
+    """
+    Fixed-capacity columnar buffer for samples. Appending is O(1) and the
+    most recent samples are always available as a view, without copying.
+
+    The data is one 2-D float array with a row per column (for instance
+    time, set temperature, temperature 1, ...) and 2*size entries, where 
+    size is capacity plus `spare` slots. Every sample is written twice, at 
+    head and at head + size, so the last `capacity` samples are always 
+    contiguous. The spare slots keep the next appends out of a view that a
+    reader in another thread still uses. Samples that are pushed out can be
+    written to a file, see `spill_file`.
+    """
+
+    def __init__(self, capacity, columns, spill_file=None, spare=1024):
+        # capacity: number of samples that are kept
+        # columns: list of column names
+        # spill_file: path or open binary file, samples that are pushed out
+        #   are appended as rows of float64 values
+        # spare: number of appends before a view of all kept samples is
+        #   overwritten
+        self.capacity = capacity
+        self.size = capacity + spare
+        self.columns = list(columns)
+        self.index = {name: n for n, name in enumerate(self.columns)}
+        self.data = np.zeros((len(self.columns), 2*self.size))
+        self.head = 0
+        self.count = 0
+        if isinstance(spill_file, str):
+            spill_file = open(spill_file, 'ab')
+        self.spill_file = spill_file
+
+    def append(self, row):
+        # row: one value per column
+        # the count is increased last, so readers in other threads that take
+        # the count first never see a row that is still being written, and
+        # their view stays valid for the next `spare` appends
+        if self.spill_file is not None and self.count >= self.capacity:
+            self.spill_file.write(self.data[:, (self.count - self.capacity) % self.size].tobytes())
+        self.data[:, self.head] = row
+        self.data[:, self.head + self.size] = row
+        self.head = (self.head + 1) % self.size
+        self.count = self.count + 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def latest(self, n=None, count=None):
+        # view of the last n samples (all kept samples if n is None), shape
+        # (number of columns, n), oldest sample first
+        # count: total number of samples to use as the end, default the
+        #   current total
+        if count is None:
+            count = self.count
+        kept = min(count, self.capacity)
+        size = kept if n is None else min(n, kept)
+        end = count % self.size + self.size
+        return self.data[:, end - size:end]
+
+    def column(self, name, n=None):
+        # view of the last n samples of one column
+        return self.latest(n)[self.index[name]]
+
+    def since(self, count):
+        # view of the samples appended after `count` samples in total, and the
+        # current total; at most the kept samples are returned
+        total = self.count
+        return self.latest(total - count, total), total
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def close(self):
+        if self.spill_file is not None:
+            # the kept samples are written too, so the file has all samples
+            self.spill_file.write(self.latest().T.tobytes())
+            self.spill_file.close()
+            self.spill_file = None
@@ -4,19 +4,170 @@ from qtpy.QtWidgets import *
 from qtpy.QtGui import *
 
 import TC720
+from buffers import RingBuffer
+import logs
 import time
 import threading
+import itertools
+from collections import deque
 import numpy as np
 import queue
+from concurrent.futures import Future
 from pathlib import Path
 from datetime import datetime
 
+class SampleScheduler():
+    """
+    Fixed-rate sampling against monotonic deadlines. The deadline of tick k
+    is t0 + k/rate, so the time spent reading does not add up to a drift.
+    Deadlines that have already passed by more than one period are skipped
+    and counted as missed.
+    """
+
+    def __init__(self, rate, t0=None, t0_wall=None):
+        # rate in Hz, 0 is as fast as possible
+        self.rate = rate
+        self.period = 1.0/rate if rate > 0 else 0
+        self.t0 = time.monotonic() if t0 is None else t0
+        self.t0_wall = time.time() if t0_wall is None else t0_wall
+        self.tick = 0
+        # tick at t0, changes with the rate
+        self.tick0 = 0
+        self.t_start = self.t0
+        # statistics
+        self.number_of_samples = 0
+        self.missed = 0
+        self.lateness_sum = 0.0
+        self.lateness_sum_of_squares = 0.0
+        self.lateness_max = 0.0
+
+    def wait(self):
+        # returns the tick to sample, after sleeping until its deadline
+        delay = self.deadline() - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return self.take()
+
+    def deadline(self):
+        # monotonic deadline of the next tick, without waiting for it
+        now = time.monotonic()
+        if self.period > 0:
+            current = self.tick0 + int((now - self.t0)/self.period)
+            if current > self.tick:
+                self.missed = self.missed + current - self.tick
+                self.tick = current
+            return self.t0 + (self.tick - self.tick0)*self.period
+        return now
+
+    def take(self):
+        # returns the tick to sample once its deadline has passed
+        if self.period > 0:
+            lateness = time.monotonic() - (self.t0 + (self.tick - self.tick0)*self.period)
+            self.lateness_sum = self.lateness_sum + lateness
+            self.lateness_sum_of_squares = self.lateness_sum_of_squares + lateness**2
+            self.lateness_max = max(self.lateness_max,lateness)
+        self.number_of_samples = self.number_of_samples + 1
+        tick = self.tick
+        self.tick = self.tick + 1
+        return tick
+
+    def time_of(self, tick):
+        # wall clock time of the deadline of a tick
+        if self.period > 0:
+            return self.t0_wall + (tick - self.tick0)*self.period
+        return time.time()
+
+    def set_rate(self, rate):
+        # change the rate from the next tick on. The next deadline is one new
+        # period after the last one, or now if that has passed already.
+        if rate == self.rate:
+            return
+        now = time.monotonic()
+        last_deadline = self.t0 + (self.tick - 1 - self.tick0)*self.period if self.period > 0 else now
+        period = 1.0/rate if rate > 0 else 0
+        t0 = max(last_deadline, now - period)
+        self.t0_wall = self.t0_wall + t0 - self.t0
+        self.t0 = t0
+        self.tick0 = self.tick - 1
+        self.rate = rate
+        self.period = period
+
+    def stats(self):
+        elapsed = time.monotonic() - self.t_start
+        n = max(self.number_of_samples,1)
+        mean = self.lateness_sum/n
+        return {'rate': self.rate,
+                'achieved_rate': self.number_of_samples/elapsed if elapsed > 0 else 0,
+                'samples': self.number_of_samples,
+                'missed': self.missed,
+                'mean_lateness': mean,
+                'jitter': max(self.lateness_sum_of_squares/n - mean**2,0)**0.5,
+                'max_lateness': self.lateness_max}
+
+
+class AdaptiveRate():
+    """
+    Chooses the sample rate from the samples: fast_rate while temperature 1
+    changes, for hold_time seconds after a change of the set temperature or
+    while the output is saturated, and slow_rate once the variance of the
+    last `window` samples of temperature 1 stays below variance_threshold.
+    """
+
+    def __init__(self, fast_rate=10, slow_rate=1, window=20, variance_threshold=0.0025, saturation=0.95, hold_time=30):
+        self.fast_rate = fast_rate
+        self.slow_rate = slow_rate
+        self.variance_threshold = variance_threshold
+        self.saturation = saturation
+        self.hold_time = hold_time
+        # running variance over the window
+        self.detector = TC720.StabilityDetector(window=window)
+        self.set_temperature = None
+        self.fast_until = 0.0
+        self.rate = fast_rate
+
+    def variance(self):
+        if len(self.detector.samples) < self.detector.samples.maxlen:
+            return None
+        return self.detector.variance()
+
+    def update(self, t, set_temperature, temperature, output):
+        # add a sample, returns the rate for the next samples
+        self.detector.add(t, temperature)
+
+        if set_temperature != self.set_temperature or abs(output) >= self.saturation:
+            self.set_temperature = set_temperature
+            self.fast_until = t + self.hold_time
+        variance = self.variance()
+        if variance == None or variance >= self.variance_threshold:
+            self.fast_until = max(self.fast_until,t + self.hold_time/10)
+        self.rate = self.fast_rate if t < self.fast_until else self.slow_rate
+        return self.rate
+
+
+def copy_future(source, target):
+    # finish target like source, unless target is already done
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() != None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
 class TC720Controller(QObject):
 
     signal_readings = Signal(list)
-    signal_plots = Signal(np.ndarray,np.ndarray)
+    # total number of samples and the new samples (rows of self.buffer)
+    signal_plots = Signal(int,np.ndarray)
 
-    def __init__(self, serial_number=None,is_simulation=False):
+    # TC720 methods that set one target. A queued call is replaced by the 
+    # next call of the same method if no other command was submitted in 
+    # between.
+    COALESCED_COMMANDS = ['set_temp','hold_temp','set_output','set_output_enable']
+
+    def __init__(self, serial_number=None,is_simulation=False,sample_rate=10,buffer_capacity=360000,spill_file=None,log_format='binary',compress=False,rotate_bytes=None,rotate_interval=None,command_timeout=10,adaptive_rate=None):
         QObject.__init__(self)
 
         # initialize the TC720 controller
@@ -30,103 +181,410 @@ class TC720Controller(QObject):
         self.tc720.set_sensor2_choice(1) # 10 kΩ thermistor, type 1 (TS-91)
 
         # controller parameters
+        # adaptive_rate: AdaptiveRate that changes the sample rate, the rate of
+        #   each sample is stored in the sample_rate column
         self.set_temperature = 20
+        self.sample_rate = sample_rate
+        self.adaptive_rate = adaptive_rate
 
         # logging and plotting
-        self.t_array = np.array([])
-        self.set_temperature_array = np.array([])
-        self.temperature1_array = np.array([])
-        self.temperature2_array = np.array([])
-        self.output_array = np.array([])
+        # the last buffer_capacity samples are kept, older samples are written
+        # to spill_file if it is given. Widgets read their window from this 
+        # buffer, the plot signal only carries the new samples.
+        self.buffer = RingBuffer(buffer_capacity,['t','set_temperature','temperature1','temperature2','output','sample_rate'],spill_file)
+        # log_format: 'binary' (see logs.py) or 'text' (tab separated)
+        # compress: gzip the log file
+        # rotate_bytes, rotate_interval: start a new log segment when the 
+        #   current one has this size in bytes or age in seconds
+        self.log_format = log_format
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        # the log file is written by its own thread, see logs.BackgroundLogWriter
         self.logging_is_on = True
-        self.counter_file_flush = 0
-        self.file = open(str(Path.home()) + "/Downloads/Temperature Controller Log File_" + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + ".csv", "w+")
-
-        # queue for updating parameters
-        self.queue_parameter_update_command = queue.Queue()
-
-        # read and write threads
-        self.lock = threading.Semaphore()
-        self.terminate_the_reading_thread = False
-        self.terminate_the_writing_thread = False
-        self.writing_lock_requested = False
-        self.thread_read = threading.Thread(target=self.read_temperature_and_output, daemon=True)
-        self.thread_write = threading.Thread(target=self.send_parameter_update_commands, daemon=True)
+        self.log_writer = logs.BackgroundLogWriter(self.open_log_file(''))
+
+        # one thread owns the serial port. It runs the commands of the 
+        # priority queue, (priority, sequence number, deadline, submit time,
+        # method name, parameters, future), and reads a sample at every tick
+        # of the scheduler when there is no command waiting. Commands of the
+        # same priority run in the order they were submitted.
+        self.queue_commands = queue.PriorityQueue()
+        self.sequence_numbers = itertools.count()
+        self.command_timeout = command_timeout
+        self.command_counts = {'done': 0, 'failed': 0, 'expired': 0, 'coalesced': 0}
+        # last submitted (sequence number, method name, future) while it has
+        # not started, and the sequence numbers of the commands that were
+        # replaced by a later call. Writes of a mode or value that the device
+        # already holds are skipped by the TC720 itself, see 
+        # TC720.write_register().
+        self.lock_commands = threading.Lock()
+        self.last_command = None
+        self.superseded = set()
+        self.command_wait_sum = 0.0
+        self.command_wait_max = 0.0
+        self.command_latency_sum = 0.0
+        self.command_latency_max = 0.0
+        # waiters of wait_for_temperature, fed with the samples of the I/O 
+        # thread: {(target, error, window, sd, slope, sensor): 
+        # (StabilityDetector, [(future, deadline)])}. samples_seen is the 
+        # buffer count of the last sample given to the detectors.
+        self.lock_waiters = threading.Lock()
+        self.waiters = {}
+        self.samples_seen = 0
+        self.terminate_the_io_thread = False
+        self.thread_io = threading.Thread(target=self.run_io, daemon=True)
         
     def start(self):
-        self.thread_read.start()
-        self.thread_write.start()
-
-    def read_temperature_and_output(self):
-        while(self.terminate_the_reading_thread == False):
-            if self.writing_lock_requested == False:
-                # read the controller
-                self.lock.acquire()
-                # set_temperature = self.tc720.get_set_temp()
-                t = time.time()
-                set_temperature = self.set_temperature
-                temperature_1 = self.tc720.get_temp()
-                temperature_2 = self.tc720.get_temp2()
-                output = self.tc720.get_output()
-                self.lock.release()
-                # build arrays
-                self.t_array = np.append(self.t_array,t)
-                self.set_temperature_array = np.append(self.set_temperature_array,set_temperature)
-                self.temperature1_array = np.append(self.temperature1_array,temperature_1)
-                self.temperature2_array = np.append(self.temperature2_array,temperature_2)
-                self.output_array = np.append(self.output_array,output)
-                # plot and display
-                plot_arrays = np.vstack((self.set_temperature_array,self.temperature1_array,self.temperature2_array,self.output_array))
-                self.signal_plots.emit(self.t_array,plot_arrays)
-                self.signal_readings.emit([self.set_temperature,temperature_1,temperature_2,output])
-                # log
-                if self.logging_is_on:
-                    self.file.write(str(t) + '\t' + 
-                                    str(set_temperature) + '\t' +
-                                    str(temperature_1) + '\t' +
-                                    str(temperature_2) + '\t' +
-                                    str(output) + '\n')
-                    self.counter_file_flush = self.counter_file_flush + 1
-                    if self.counter_file_flush>=50:
-                        self.counter_file_flush = 0
-                        self.file.flush()
+        rate = self.sample_rate if self.adaptive_rate == None else self.adaptive_rate.rate
+        self.scheduler = SampleScheduler(rate)
+        self.thread_io.start()
+
+    def run_io(self):
+        command = None
+        try:
+            while(self.terminate_the_io_thread == False):
+                # commands pre-empt the sample of the next tick
+                try:
+                    command = self.queue_commands.get(timeout=max(self.scheduler.deadline() - time.monotonic(),0))
+                except queue.Empty:
+                    self.read_temperature_and_output(self.scheduler.take())
+                    continue
+                self.run_command(command)
+                command = None
+        finally:
+            # also after an error, nothing runs the queued commands anymore
+            self.terminate_the_io_thread = True
+            if command != None and command[-1] != None and command[-1].done() == False:
+                command[-1].set_exception(RuntimeError('TC720Controller: the I/O thread stopped while running {}'.format(command[4])))
+            self.finish_pending()
+
+    def finish_pending(self):
+        # fail the futures of the queued commands and cancel the waiters of
+        # wait_for_temperature, once the I/O thread has stopped
+        while True:
+            try:
+                future = self.queue_commands.get_nowait()[-1]
+            except queue.Empty:
+                break
+            # done futures are replaced calls that follow a later call
+            if future == None or future.done():
+                continue
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError('TC720Controller is closed, the command was not sent'))
+        with self.lock_waiters:
+            for detector,futures in self.waiters.values():
+                for future,deadline in futures:
+                    future.cancel()
+            self.waiters.clear()
+
+    def read_temperature_and_output(self,tick):
+        t = self.scheduler.time_of(tick)
+        rate = self.scheduler.rate
+        set_temperature = self.set_temperature
+        try:
+            temperature_1, temperature_2, output = self.tc720.query_many(['01', '04', '02'])
+        except Exception as e:
+            print('TC720Controller: sample {} failed: {}'.format(tick,e))
+            self.update_waiters(None)
+            return
+        # store
+        self.buffer.append((t,set_temperature,temperature_1,temperature_2,output,rate))
+        # plot and display
+        self.signal_plots.emit(self.buffer.count,self.buffer.latest(1).copy())
+        self.signal_readings.emit([self.set_temperature,temperature_1,temperature_2,output])
+        # log
+        if self.logging_is_on:
+            self.log_writer.write((t,set_temperature,temperature_1,temperature_2,output,rate))
+        self.update_waiters((t,set_temperature,temperature_1,temperature_2,output,rate))
+        # rate of the next samples
+        if self.adaptive_rate != None:
+            self.scheduler.set_rate(self.adaptive_rate.update(t,set_temperature,temperature_1,output))
+
+    def run_command(self,command):
+        priority,number,deadline,submitted,method_name,parameters,future = command
+        if future == None:
+            # stop command of close()
+            return
+        with self.lock_commands:
+            superseded = number in self.superseded
+            self.superseded.discard(number)
+            if self.last_command != None and self.last_command[0] == number:
+                # a started command can not be replaced
+                self.last_command = None
+        if superseded:
+            # a later call replaced this one, its future follows the later one
+            self.command_counts['coalesced'] = self.command_counts['coalesced'] + 1
+            return
+        if future.set_running_or_notify_cancel() == False:
+            return
+        started = time.monotonic()
+        if started > deadline:
+            self.command_counts['expired'] = self.command_counts['expired'] + 1
+            future.set_exception(TimeoutError('{}{} was not sent within its deadline'.format(method_name,tuple(parameters))))
+            return
+        try:
+            result = getattr(self.tc720,method_name)(*parameters)
+        except Exception as e:
+            self.command_counts['failed'] = self.command_counts['failed'] + 1
+            print('TC720Controller: {}{} failed: {}'.format(method_name,tuple(parameters),e))
+            future.set_exception(e)
+            return
+        # update the controller object
+        if method_name in ['set_temp','hold_temp']:
+            self.set_temperature = parameters[0]
+        finished = time.monotonic()
+        self.command_counts['done'] = self.command_counts['done'] + 1
+        self.command_wait_sum = self.command_wait_sum + started - submitted
+        self.command_wait_max = max(self.command_wait_max,started - submitted)
+        self.command_latency_sum = self.command_latency_sum + finished - submitted
+        self.command_latency_max = max(self.command_latency_max,finished - submitted)
+        future.set_result(result)
+
+    def submit(self,method_name,parameters=(),priority=0,timeout=None):
+        # queue a call of a TC720 method for the I/O thread, lower priority 
+        # numbers run first. The command expires if it has not started within
+        # timeout seconds (default command_timeout). A waiting call of one of
+        # the COALESCED_COMMANDS is replaced by this call if it was the last
+        # submitted command. Returns a 
+        # concurrent.futures.Future, use asyncio.wrap_future() to await it.
+        if timeout == None:
+            timeout = self.command_timeout
+        future = Future()
+        with self.lock_commands:
+            number = next(self.sequence_numbers)
+            previous = self.last_command
+            self.last_command = (number,method_name,future)
+            coalesce = method_name in self.COALESCED_COMMANDS and previous != None and previous[1] == method_name
+            if coalesce:
+                self.superseded.add(previous[0])
+        if coalesce:
+            future.add_done_callback(lambda f,previous=previous[2]: copy_future(f,previous))
+        submitted = time.monotonic()
+        self.queue_commands.put((priority,number,submitted + timeout,submitted,method_name,list(parameters),future))
+        if self.terminate_the_io_thread:
+            # the I/O thread may have stopped before the put
+            self.finish_pending()
+        return future
+
+    def wait_for_temperature(self,target,error=1,window=5,sd=0.01,slope=None,timeout=None,sensor='temperature1'):
+        # returns a concurrent.futures.Future with the time of the sample at
+        # which the temperature of sensor was within error of target and 
+        # stable, see TC720.StabilityDetector. The future is fed with the 
+        # samples that are read anyway, waiting does not read from the device.
+        # Waiters with the same parameters share one detector, a new detector
+        # starts with the last window samples of the buffer. After timeout 
+        # seconds the future gets a TimeoutError. Use future.cancel() to stop
+        # waiting and asyncio.wrap_future() to await it.
+        if sensor not in ['temperature1','temperature2']:
+            raise ValueError('Invalid sensor: {}, should be temperature1 or temperature2'.format(repr(sensor)))
+        future = Future()
+        deadline = time.monotonic() + timeout if timeout != None else float('inf')
+        key = (target,error,window,sd,slope,sensor)
+        with self.lock_waiters:
+            if key not in self.waiters:
+                detector = TC720.StabilityDetector(target,error,window,sd,slope)
+                history = self.buffer.latest(window,self.samples_seen)
+                for t,temperature in zip(history[self.buffer.index['t']],history[self.buffer.index[sensor]]):
+                    detector.add(t,temperature)
+                self.waiters[key] = (detector,[])
+            detector,futures = self.waiters[key]
+            if detector.stable:
+                future.set_running_or_notify_cancel()
+                future.set_result(detector.stable_since)
             else:
-                pass
-            time.sleep(0.1)
-
-    def send_parameter_update_commands(self):
-        while(self.terminate_the_writing_thread == False):
-            while self.queue_parameter_update_command.empty() == False:
-                # update the controller
-                self.writing_lock_requested = True
-                self.lock.acquire()
-                self.writing_lock_requested = False
-                method_name,parameters = self.queue_parameter_update_command.get()
-                self._update_controller_parameter(method_name,parameters)
-                self.lock.release()
-                # update the controller object
-                if method_name == 'set_temp':
-                    self.set_temperature = parameters[0]
-            time.sleep(0.1)
+                futures.append((future,deadline))
+        return future
 
-    def update_controller_parameter(self,method_name,parameters):
-        self.queue_parameter_update_command.put((method_name,parameters))
+    def update_waiters(self,sample):
+        # give a sample (row of the buffer, None if the read failed) to the 
+        # waiters of wait_for_temperature, runs in the I/O thread
+        now = time.monotonic()
+        with self.lock_waiters:
+            if sample != None:
+                self.samples_seen = self.buffer.count
+            for key in list(self.waiters):
+                detector,futures = self.waiters[key]
+                stable = sample != None and detector.add(sample[0],sample[self.buffer.index[key[5]]])
+                for future,deadline in futures:
+                    if stable or now > deadline:
+                        # cancelled futures return False
+                        if future.set_running_or_notify_cancel() == False:
+                            continue
+                        if stable:
+                            future.set_result(detector.stable_since)
+                        else:
+                            future.set_exception(TimeoutError('Temperature {} was not reached within the timeout'.format(key[0])))
+                futures[:] = [(future,deadline) for future,deadline in futures if future.done() == False]
+                if len(futures) == 0:
+                    del self.waiters[key]
+
+    def sampling_stats(self):
+        return self.scheduler.stats()
 
-    def _update_controller_parameter(self,method_name,parameters):
-        method = getattr(self.tc720,method_name)
-        method(*parameters)
+    def command_stats(self):
+        # wait: from submit to the start of the command (at most one sample
+        # read), latency: from submit to the reply of the device
+        # writes_avoided: commands that were replaced by a later call 
+        # (coalesced) and register writes that the TC720 skipped because the
+        # device held the value
+        done = max(self.command_counts['done'],1)
+        skipped = self.tc720.register_stats()['hits'] if hasattr(self.tc720,'register_stats') else 0
+        return dict(self.command_counts,
+                    writes_avoided=self.command_counts['coalesced'] + skipped,
+                    mean_wait=self.command_wait_sum/done,
+                    max_wait=self.command_wait_max,
+                    mean_latency=self.command_latency_sum/done,
+                    max_latency=self.command_latency_max,
+                    queued=self.queue_commands.qsize())
+
+    def logging_stats(self):
+        return self.log_writer.stats()
+
+    def update_controller_parameter(self,method_name,parameters):
+        return self.submit(method_name,parameters)
 
     def logging_onoff(self,state,experiment_id):
-        self.logging_is_on = state
+        # the log writer switches files between two samples, no sample is
+        # lost or written to the wrong file
         if state == False:
-            self.file.close()
+            self.logging_is_on = False
+            self.log_writer.swap(None)
         else:
             self.experiment_id = experiment_id
-            self.file = open(str(Path.home()) + "/Downloads/" + self.experiment_id + '_Temperature Controller Log File_' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + ".csv", "w+")
+            self.log_writer.swap(self.open_log_file(self.experiment_id + '_'))
+            self.logging_is_on = True
+
+    def open_log_file(self,prefix):
+        path = str(Path.home()) + "/Downloads/" + prefix + 'Temperature Controller Log File_' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f')
+        if self.rotate_bytes is not None or self.rotate_interval is not None:
+            return logs.RotatingLogWriter(path,self.buffer.columns,self.log_format,self.compress,self.rotate_bytes,self.rotate_interval)
+        return logs.make_writer(path,self.buffer.columns,self.log_format,self.compress)
+
+    def close(self):
+        self.terminate_the_io_thread = True
+        # wake the I/O thread before all other commands
+        self.queue_commands.put((-1,next(self.sequence_numbers),0,0,None,None,None))
+        if self.thread_io.is_alive():
+            self.thread_io.join()
+        self.finish_pending()
+        self.log_writer.close()
+        self.buffer.close()
+
+
+class FleetController(QObject):
+    """
+    Polls several TC-720s at the same time, with one I/O thread per device.
+    All devices are read on a shared clock of ticks, so the samples of one
+    tick are aligned in time. The samples of each tick are published 
+    together as a list of (device_id, t, set_temp, temp1, temp2, output) 
+    tuples, where t is the time of the tick. A device that fails to read a
+    tick is left out of it, the tick is published after tick_timeout 
+    seconds at the latest.
+    """
+
+    signal_samples = Signal(list)
+
+    def __init__(self, serial_numbers, sample_rate=10, is_simulation=False):
+        QObject.__init__(self)
+
+        # initialize the TC720 controllers, the serial number is the device id
+        self.devices = {}
+        for serial_number in serial_numbers:
+            if is_simulation == False:
+                self.devices[serial_number] = TC720.TC720(serial_number=serial_number)
+            else:
+                self.devices[serial_number] = TC720.TC720_simulation(serial_number=serial_number)
+            self.devices[serial_number].set_sensor1_choice(1) # 10 kΩ thermistor, type 1 (TS-91)
+            self.devices[serial_number].set_sensor2_choice(1) # 10 kΩ thermistor, type 1 (TS-91)
+
+        # controller parameters
+        self.set_temperature = {device_id: 20 for device_id in self.devices}
+        self.sample_rate = sample_rate
+
+        # queues for updating parameters, one per device
+        self.queue_parameter_update_command = {device_id: queue.Queue() for device_id in self.devices}
+
+        # samples of all devices, grouped per tick by the publishing thread.
+        # A device reports None for a tick it failed to read.
+        self.queue_samples = queue.Queue()
+        self.number_of_samples = 0
+        self.number_of_failed_samples = 0
+        self.tick_timeout = max(1.0,2.0/sample_rate) if sample_rate > 0 else 1.0
+        self.devices_alive = set(self.devices)
+
+        # one I/O thread per device and one publishing thread
+        self.terminate = False
+        self.threads_poll = [threading.Thread(target=self.poll_device, args=(device_id,), daemon=True) for device_id in self.devices]
+        self.thread_publish = threading.Thread(target=self.publish_samples, daemon=True)
+
+    def start(self):
+        # one scheduler per device on a shared clock
+        t0 = time.monotonic()
+        t0_wall = time.time()
+        self.schedulers = {device_id: SampleScheduler(self.sample_rate,t0,t0_wall) for device_id in self.devices}
+        for thread in self.threads_poll:
+            thread.start()
+        self.thread_publish.start()
+
+    def poll_device(self, device_id):
+        tc720 = self.devices[device_id]
+        scheduler = self.schedulers[device_id]
+        try:
+            while self.terminate == False:
+                # handle queued parameter updates between readings
+                while self.queue_parameter_update_command[device_id].empty() == False:
+                    method_name,parameters = self.queue_parameter_update_command[device_id].get()
+                    try:
+                        getattr(tc720,method_name)(*parameters)
+                    except Exception as e:
+                        print('FleetController: {} {}{} failed: {}'.format(device_id,method_name,tuple(parameters),e))
+                        continue
+                    if method_name == 'set_temp':
+                        self.set_temperature[device_id] = parameters[0]
+                # wait for the tick, missed ticks are skipped
+                tick = scheduler.wait()
+                try:
+                    temperature_1, temperature_2, output = tc720.query_many(['01', '04', '02'])
+                except Exception as e:
+                    print('FleetController: {} sample {} failed: {}'.format(device_id,tick,e))
+                    self.queue_samples.put((tick,None))
+                    continue
+                t = scheduler.time_of(tick)
+                self.queue_samples.put((tick,(device_id,t,self.set_temperature[device_id],temperature_1,temperature_2,output)))
+        finally:
+            # the other devices do not wait for this one anymore
+            self.devices_alive.discard(device_id)
+
+    def publish_samples(self):
+        # tick: (time of the first report, reports)
+        pending = {}
+        while self.terminate == False:
+            try:
+                tick,sample = self.queue_samples.get(timeout=0.1)
+                pending.setdefault(tick,(time.monotonic(),[]))[1].append(sample)
+            except queue.Empty:
+                pass
+            # a tick is published when all live devices have reported, after
+            # tick_timeout seconds, or when a later tick is published (a 
+            # device skipped the tick)
+            now = time.monotonic()
+            complete = [k for k in pending if len(pending[k][1]) >= len(self.devices_alive) or now - pending[k][0] > self.tick_timeout]
+            if complete:
+                last = max(complete)
+                for k in sorted(k for k in pending if k <= last):
+                    reports = pending.pop(k)[1]
+                    batch = sorted([sample for sample in reports if sample != None], key=lambda sample: list(self.devices).index(sample[0]))
+                    self.number_of_failed_samples = self.number_of_failed_samples + len(reports) - len(batch)
+                    if batch:
+                        self.number_of_samples = self.number_of_samples + len(batch)
+                        self.signal_samples.emit(batch)
+
+    def update_controller_parameter(self,device_id,method_name,parameters):
+        self.queue_parameter_update_command[device_id].put((method_name,parameters))
 
     def close(self):
-        self.terminate_the_reading_thread = True
-        self.terminate_the_writing_thread = True
-        self.thread_read.join()
-        self.thread_write.join()
-        self.file.close()
+        self.terminate = True
+        for thread in self.threads_poll:
+            thread.join()
+        self.thread_publish.join()
@@ -0,0 +1,193 @@
+################################################################################
+#TC-720 emulator on a pseudo-terminal (Linux/macOS only).
+#
+#Speaks the serial protocol of the TC-720, so the TC720 class can be used and
+#benchmarked without hardware: TC720.TC720(device.address). Messages *CCDDDDSS\r
+#are answered with *DDDDSS^ after the processing latency and the transmission
+#time at the baud rate. Write commands set the registers of a
+#TC720.TC720_simulation, so the temperatures respond like a real setup, and
+#are acknowledged by repeating the value.
+#
+#Faults can be injected on demand with inject() or at random with fault_rates:
+#'checksum': the reply is *XXXX60^, like the device after a checksum error.
+#'drop': one byte of the reply is lost.
+#'drop_end': the terminator ^ of the reply is lost.
+#'delay': the reply is sent `delay` seconds late.
+#
+#Usage:
+#device = emulator.EmulatedTC720()
+#tc = TC720.TC720(device.address)
+#device.inject('checksum', count=2)
+#tc.get_temp()
+#device.close()
+################################################################################
+
+import os
+import threading
+import time
+
+import numpy as np
+
+import TC720
+
+FAULTS = ['checksum', 'drop', 'drop_end', 'delay']
+
+#Write commands that are not in TC720Protocol.read_commands.
+OTHER_WRITE_COMMANDS = ['08', '20', '30', '47']
+
+#Read command of every program field, for instance 'a8' is the temperature of
+#location 1.
+PROGRAM_READ_COMMANDS = {code + hex(location + 7)[-1]: (field, location) for field, code in TC720.PROGRAM_FIELDS for location in range(1, 9)}
+
+class EmulatedTC720():
+    """
+    TC-720 stand-in on a pseudo-terminal, see the top of this file.
+    Input:
+    `baudrate`(int): Baud rate of the emulated serial line, 10 bits per
+        byte. Default = 230400
+    `latency`(float): Seconds between receiving a message and starting the
+        reply. Default = 0.001
+    `simulation`(TC720_simulation): Simulated device that holds the
+        registers. Default = a new TC720_simulation without latency.
+    `seed`(int): Seed of the random faults. Default = None
+
+    """
+    def __init__(self, baudrate = 230400, latency = 0.001, simulation = None, seed = None):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.simulation = TC720.TC720_simulation(latency = 0) if simulation == None else simulation
+        # registers that are not simulated, like the sensor choices
+        self.registers = {}
+
+        # faults
+        self.fault_rates = {fault: 0.0 for fault in FAULTS}
+        self.delay = 1.5
+        self.forced_faults = []
+        self.random = np.random.default_rng(seed)
+        self.counts = {'messages': 0, 'bad_messages': 0}
+        self.counts.update({fault: 0 for fault in FAULTS})
+
+        self.master, self.slave = os.openpty()
+        self.address = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    #==========================================================================
+    #    Faults
+    #==========================================================================
+
+    def inject(self, fault, count = 1, after = 0):
+        """
+        Give `count` replies one of the FAULTS, starting after `after` 
+        correct replies.
+
+        """
+        if fault not in FAULTS:
+            raise ValueError('Invalid fault: {}, should be one of {}'.format(repr(fault), FAULTS))
+        self.forced_faults.extend([None] * after + [fault] * count)
+
+    def next_fault(self):
+        if len(self.forced_faults) > 0:
+            return self.forced_faults.pop(0)
+        for fault in FAULTS:
+            if self.fault_rates[fault] > 0 and self.random.random() < self.fault_rates[fault]:
+                return fault
+        return None
+
+    #==========================================================================
+    #    Protocol
+    #==========================================================================
+
+    def reply(self, value):
+        value = '{:04x}'.format(value % 2**16)
+        checksum = '{:02x}'.format(sum(value.encode('ascii')) % 256)
+        return ('*' + value + checksum + '^').encode('ascii')
+
+    def write_register(self, command, value):
+        # value: signed integer as it is sent
+        simulation = self.simulation
+        if command == '1c':
+            simulation.set_temperature = value / 100
+        elif command == '3d':
+            simulation.mode = value
+            simulation.reset_pid()
+        elif command == '3f':
+            simulation.control_type = value
+            simulation.reset_pid()
+        elif command == '40':
+            simulation.set_output_level = value / 511.0
+        elif command == '30':
+            simulation.output_enable = value
+        elif command == '08':
+            if value == 1 and simulation.mode == 1:
+                simulation.start_program()
+            else:
+                simulation.running = False
+        elif command in TC720.TC720Protocol.read_commands:
+            field, location = PROGRAM_READ_COMMANDS[TC720.TC720Protocol.read_commands[command]]
+            simulation.program[location - 1][field] = value / 100 if field == 'temp' else value
+        else:
+            self.registers[command] = value
+
+    def read_register(self, command):
+        # returns the signed integer that is sent
+        if command in ['01', '04', '02', '50', '74', '71', '73', '09'] or command in PROGRAM_READ_COMMANDS:
+            value = self.simulation.read_value(command)
+            return int(round(value * TC720.TC720Protocol.response_scale.get(command, 1)))
+        return self.registers.get(command, 0)
+
+    def handle(self, message):
+        """
+        Returns the reply to one message, without the end character \\r.
+
+        """
+        checksum = '{:02x}'.format(sum(message[1:7].encode('ascii')) % 256)
+        if len(message) != 9 or message[0] != '*' or message[7:9] != checksum:
+            self.counts['bad_messages'] = self.counts['bad_messages'] + 1
+            return b'*XXXX60^'
+        command = message[1:3]
+        value = int(message[3:7], 16)
+        if value >= 2**15:
+            value = value - 2**16
+        with self.simulation.lock:
+            self.simulation.advance()
+            if command in TC720.TC720Protocol.read_commands or command in OTHER_WRITE_COMMANDS:
+                self.write_register(command, value)
+                return self.reply(value)
+            return self.reply(self.read_register(command))
+
+    def serve(self):
+        buffer = b''
+        while self.running:
+            try:
+                buffer += os.read(self.master, 64)
+            except OSError:
+                break
+            while b'\r' in buffer:
+                message, buffer = buffer.split(b'\r', 1)
+                self.counts['messages'] = self.counts['messages'] + 1
+                response = self.handle(message.decode('ascii', 'replace'))
+                fault = self.next_fault()
+                if fault != None:
+                    self.counts[fault] = self.counts[fault] + 1
+                if fault == 'checksum':
+                    response = b'*XXXX60^'
+                elif fault == 'drop':
+                    n = self.random.integers(len(response))
+                    response = response[:n] + response[n + 1:]
+                elif fault == 'drop_end':
+                    response = response[:-1]
+                elif fault == 'delay':
+                    time.sleep(self.delay)
+                # processing and transmission time
+                time.sleep(self.latency + 10 * (len(message) + 1 + len(response)) / self.baudrate)
+                try:
+                    os.write(self.master, response)
+                except OSError:
+                    break
+
+    def close(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
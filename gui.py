@@ -19,7 +19,7 @@ class GUI(QMainWindow):
 
 		# widget
 		self.controlPanel = widgets.ControlPanel()
-		self.waveformDisplay = widgets.WaveformDisplay()
+		self.waveformDisplay = widgets.WaveformDisplay(buffer=self.tc720Controller.buffer)
 
 		# lay out widgets
 		layout = QHBoxLayout()
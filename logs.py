@@ -0,0 +1,576 @@
+################################################################################
+#Binary log format for the temperature controller.
+#
+#A log file starts with a header of HEADER_SIZE bytes, an ASCII line padded
+#with spaces:
+#TC720LOG 1 t,set_temperature,temperature1,temperature2,output
+#followed by fixed-width records of little-endian float64 values, one per
+#column. The records can be read in one call:
+#np.fromfile(path, dtype=log_dtype(columns), offset=HEADER_SIZE)
+#or memory mapped with open_log().
+#
+#Log files can be gzip compressed (path ends with .gz) and split in segments
+#by RotatingLogWriter, with an index of the time range of every segment that
+#read_time_range() uses to open only the segments it needs. LogReader memory
+#maps a log or a set of segments and returns windows in time without copying.
+#
+#BackgroundLogWriter moves the writing to its own thread, so a slow disk does
+#not delay the sampling.
+################################################################################
+
+import bisect
+import gzip
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+MAGIC = 'TC720LOG'
+VERSION = 1
+HEADER_SIZE = 256
+COLUMNS = ['t', 'set_temperature', 'temperature1', 'temperature2', 'output']
+EXTENSIONS = {'binary': '.tc720log', 'text': '.csv'}
+
+def log_dtype(columns):
+    """
+    Structured dtype of one record.
+
+    """
+    return np.dtype([(name, '<f8') for name in columns])
+
+def make_header(columns):
+    """
+    Returns the header for the columns as bytes.
+
+    """
+    header = '{} {} {}\n'.format(MAGIC, VERSION, ','.join(columns)).encode('ascii')
+    if len(header) > HEADER_SIZE:
+        raise ValueError('Too many columns for the log header: {}'.format(columns))
+    return header[:-1] + b' ' * (HEADER_SIZE - len(header)) + b'\n'
+
+def read_header(path):
+    """
+    Read the header of a log file.
+    Returns the list of column names.
+
+    """
+    with open_file(path, 'rb') as f:
+        header = f.read(HEADER_SIZE).decode('ascii').split()
+    if len(header) != 3 or header[0] != MAGIC:
+        raise ValueError('{} is not a temperature controller log file.'.format(path))
+    if int(header[1]) != VERSION:
+        raise ValueError('Unsupported log version {} in {}.'.format(header[1], path))
+    return header[2].split(',')
+
+def open_file(path, mode):
+    """
+    Open a file, gzip compressed if the path ends with .gz.
+
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class LogFile():
+    """
+    The file of a log writer. Writes are buffered by the file object and
+    written to disk on flush() or close(). A compressed file is only flushed
+    every FLUSH_BYTES, because every flush ends a compression block and small
+    blocks hardly compress.
+
+    """
+    FLUSH_BYTES = 65536
+
+    def open(self, path, mode):
+        self.path = path
+        self.compressed = path.endswith('.gz')
+        self.file = open_file(path, mode)
+        self.unflushed = 0
+
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.unflushed = self.unflushed + len(data)
+
+    def flush(self):
+        if self.compressed == False or self.unflushed >= self.FLUSH_BYTES:
+            self.file.flush()
+            self.unflushed = 0
+
+    def size(self):
+        # bytes on disk, without what is still in the buffers
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.file.close()
+
+class BinaryLogWriter(LogFile):
+    """
+    Append-only writer of the binary log format, compressed if the path ends
+    with .gz.
+
+    """
+    def __init__(self, path, columns=COLUMNS):
+        self.columns = list(columns)
+        self.dtype = log_dtype(self.columns)
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        # an existing file must have the same columns, a new file gets a header
+        if exists and read_header(path) != self.columns:
+            raise ValueError('{} has different columns than {}.'.format(path, self.columns))
+        if exists == False:
+            self.number_of_records = 0
+        elif path.endswith('.gz'):
+            self.number_of_records = len(open_log(path))
+        else:
+            self.number_of_records = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+        self.open(path, 'ab')
+        if exists == False:
+            self.write_bytes(make_header(self.columns))
+            self.file.flush()
+
+    def write(self, row):
+        """
+        Write one record, one value per column.
+
+        """
+        self.write_bytes(np.asarray(row, dtype='<f8').tobytes())
+        self.number_of_records = self.number_of_records + 1
+
+    def write_many(self, rows):
+        """
+        Write several records at once, an array with one row per record.
+
+        """
+        rows = np.asarray(rows, dtype='<f8').reshape(-1, len(self.columns))
+        self.write_bytes(rows.tobytes())
+        self.number_of_records = self.number_of_records + len(rows)
+
+class TextLogWriter(LogFile):
+    """
+    Writer of the tab separated text log, with the same functions as
+    BinaryLogWriter.
+
+    """
+    def __init__(self, path, columns=COLUMNS, delimiter='\t'):
+        self.columns = list(columns)
+        self.delimiter = delimiter
+        self.open(path, 'ab')
+        self.number_of_records = 0
+
+    def write(self, row):
+        self.write_many([row])
+
+    def write_many(self, rows):
+        self.write_bytes(''.join([self.delimiter.join(map(str, row)) + '\n' for row in rows]).encode('ascii'))
+        self.number_of_records = self.number_of_records + len(rows)
+
+def make_writer(path, columns=COLUMNS, log_format='binary', compress=False):
+    """
+    Open a log writer.
+    Input:
+    `path`(str): Path of the log file without extension.
+    `columns`(list): Column names.
+    `log_format`(str): 'binary' or 'text'. Default = 'binary'
+    `compress`(bool): If True the file is gzip compressed. Default = False
+    Returns a BinaryLogWriter or TextLogWriter.
+
+    """
+    path = path + EXTENSIONS[log_format] + ('.gz' if compress else '')
+    if log_format == 'binary':
+        return BinaryLogWriter(path, columns)
+    return TextLogWriter(path, columns)
+
+class RotatingLogWriter():
+    """
+    Log writer that starts a new segment file when the current segment is
+    larger than `max_bytes` or older than `interval` seconds. Segments are 
+    named <path>_0001.tc720log, <path>_0002.tc720log, ... Every segment is
+    listed in the index <path>.index, a tab separated text file with per 
+    segment the file name, the first and last time (the first column) and 
+    the number of records. The segment that is being written is listed when
+    it is opened (times nan) and updated at every flush, read_index() reads
+    the latest records of this last segment from the segment itself.
+
+    """
+    def __init__(self, path, columns=COLUMNS, log_format='binary', compress=False, max_bytes=None, interval=None):
+        self.path = path
+        self.index_path = path + '.index'
+        self.columns = list(columns)
+        self.log_format = log_format
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.segment = 0
+        self.number_of_records = 0
+        # index lines of the closed segments
+        self.index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = f.readlines()
+        self.open_segment()
+
+    def open_segment(self):
+        self.segment = self.segment + 1
+        self.writer = make_writer('{}_{:04d}'.format(self.path, self.segment), self.columns, self.log_format, self.compress)
+        self.opened = time.time()
+        self.t_first = None
+        self.t_last = None
+        self.write_index(True)
+
+    def index_line(self):
+        t_first = float('nan') if self.t_first is None else self.t_first
+        t_last = float('nan') if self.t_last is None else self.t_last
+        return '{}\t{!r}\t{!r}\t{}\n'.format(os.path.basename(self.writer.path), t_first, t_last, self.writer.number_of_records)
+
+    def write_index(self, with_current):
+        # the whole index is replaced at once, readers never see half a line
+        lines = self.index + ([self.index_line()] if with_current else [])
+        with open(self.index_path + '.tmp', 'w') as f:
+            f.writelines(lines)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def close_segment(self):
+        self.writer.close()
+        # an empty segment is left out of the index
+        if self.writer.number_of_records > 0:
+            self.index.append(self.index_line())
+        self.write_index(False)
+
+    def must_rotate(self):
+        if self.writer.number_of_records == 0:
+            return False
+        if self.max_bytes is not None and self.writer.size() >= self.max_bytes:
+            return True
+        if self.interval is not None and time.time() - self.opened >= self.interval:
+            return True
+        return False
+
+    def write(self, row):
+        self.write_many([row])
+
+    def write_many(self, rows):
+        if len(rows) == 0:
+            return
+        if self.must_rotate():
+            self.close_segment()
+            self.open_segment()
+        self.writer.write_many(rows)
+        if self.t_first is None:
+            self.t_first = float(rows[0][0])
+        self.t_last = float(rows[-1][0])
+        self.number_of_records = self.number_of_records + len(rows)
+
+    def flush(self):
+        self.writer.flush()
+        self.write_index(True)
+
+    def close(self):
+        self.close_segment()
+
+def read_index(index_path):
+    """
+    Read the index of a RotatingLogWriter.
+    Returns a list with per segment a tuple of: path, first time, last time,
+    number of records. The last segment may still be written, or was left
+    open by a crash, so its records are counted in the segment itself.
+
+    """
+    directory = os.path.dirname(index_path)
+    segments = []
+    with open(index_path) as f:
+        for line in f:
+            name, t_first, t_last, number_of_records = line.rstrip('\n').split('\t')
+            segments.append((os.path.join(directory, name), float(t_first), float(t_last), int(number_of_records)))
+    if len(segments) > 0 and EXTENSIONS['binary'] in os.path.basename(segments[-1][0]) and os.path.exists(segments[-1][0]):
+        path = segments[-1][0]
+        log = open_log(path)
+        if len(log) > 0:
+            segments[-1] = (path, float(log[0][0]), float(log[-1][0]), len(log))
+        else:
+            segments[-1] = (path, float('nan'), float('nan'), 0)
+    if len(segments) > 0 and segments[-1][3] == 0:
+        # nothing written to the last segment yet
+        segments.pop()
+    return segments
+
+def read_time_range(index_path, t_start=None, t_end=None):
+    """
+    Read the records between two times from a rotated binary log. Only the
+    segments that overlap the time range are opened. The records of the 
+    segment that is still being written are included up to the last flush.
+    Input:
+    `index_path`(str): Path of the index file.
+    `t_start`(float): First time, None for the start of the log. Default = None
+    `t_end`(float): Last time, None for the end of the log. Default = None
+    Returns a structured array with one field per column.
+
+    """
+    segments = read_index(index_path)
+    parts = []
+    for path, t_first, t_last, number_of_records in segments:
+        if (t_start is not None and t_last < t_start) or (t_end is not None and t_first > t_end):
+            continue
+        log = open_log(path)
+        # the times in a segment are increasing
+        t = log[log.dtype.names[0]]
+        first = 0 if t_start is None else np.searchsorted(t, t_start, side='left')
+        last = len(log) if t_end is None else np.searchsorted(t, t_end, side='right')
+        parts.append(np.array(log[first:last]))
+    if len(parts) == 0:
+        columns = read_header(segments[0][0]) if len(segments) > 0 else COLUMNS
+        return np.zeros(0, dtype=log_dtype(columns))
+    return np.concatenate(parts)
+
+#Control messages of the BackgroundLogWriter.
+_SWAP = object()
+_CLOSE = object()
+
+class BackgroundLogWriter():
+    """
+    Writes samples to a log writer (BinaryLogWriter or TextLogWriter) from a
+    separate thread. write() only puts the sample in a bounded queue and
+    never blocks; when the queue is full the sample is dropped and counted.
+    The thread writes the samples in batches of `batch_size` samples, or
+    after `batch_interval` seconds, whatever comes first, and flushes the
+    file after every batch.
+
+    swap() replaces the log writer in the order of the samples: all samples
+    written before the swap go to the old file, all samples after it to the
+    new file. swap() and close() use a separate, unbounded queue, so they do
+    not block when the sample queue is full.
+
+    """
+    def __init__(self, writer=None, max_queue=10000, batch_size=500, batch_interval=1.0):
+        self.writer = writer
+        self.queue = queue.Queue(max_queue)
+        # swaps and close, (number of samples queued before, _SWAP or 
+        # _CLOSE, writer)
+        self.control = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.taken = 0
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        # counters
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, row):
+        """
+        Queue one record, one value per column.
+        Returns False if the queue is full and the record is dropped.
+
+        """
+        with self.lock:
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                self.dropped = self.dropped + 1
+                return False
+            self.queued = self.queued + 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def swap(self, writer):
+        """
+        Continue with a new log writer, the old writer is closed by the thread
+        after its last samples are written. With writer=None the samples are
+        discarded until the next swap.
+
+        """
+        with self.lock:
+            self.control.put((self.queued, _SWAP, writer))
+
+    def close(self):
+        """
+        Write the queued samples, close the log writer and stop the thread.
+
+        """
+        if self.thread.is_alive():
+            with self.lock:
+                self.control.put((self.queued, _CLOSE, None))
+            self.thread.join()
+
+    def stats(self):
+        """
+        Returns a dictionary with the current and maximum number of queued
+        samples, and the number of written and dropped samples and batches.
+
+        """
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'written': self.written,
+                'dropped': self.dropped,
+                'batches': self.batches}
+
+    def write_batch(self, batch):
+        if len(batch) > 0 and self.writer is not None:
+            # a failing disk loses the batch, but does not stop the thread
+            try:
+                self.writer.write_many(batch)
+                self.writer.flush()
+            except OSError as e:
+                print('Log writer: could not write {} samples to {}: {}'.format(len(batch), self.writer.path, e))
+                self.dropped = self.dropped + len(batch)
+                return
+            self.written = self.written + len(batch)
+            self.batches = self.batches + 1
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.batch_interval
+        control = None
+        while True:
+            if control is None:
+                try:
+                    control = self.control.get_nowait()
+                except queue.Empty:
+                    pass
+            # a swap or close is done once the samples before it are taken
+            if control is not None and self.taken >= control[0]:
+                self.write_batch(batch)
+                batch = []
+                if self.writer is not None:
+                    self.writer.close()
+                self.writer = control[2]
+                if control[1] is _CLOSE:
+                    return
+                control = None
+                continue
+            try:
+                # wake up regularly to see new swaps
+                batch.append(self.queue.get(timeout=min(max(0, deadline - time.monotonic()), 0.05)))
+                self.taken = self.taken + 1
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self.write_batch(batch)
+                batch = []
+                deadline = time.monotonic() + self.batch_interval
+
+class LogReader():
+    """
+    Read windows in time from a binary log file, or from the segments of a
+    rotated log when `path` is the .index file. The segments are memory
+    mapped when they are first used and the time column (the first column) 
+    is searched with a binary search, so opening a log of many days and 
+    jumping to any hour only reads a few pages from disk. Compressed 
+    segments are read into memory.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.index'):
+            self.segments = [(segment, t_first, t_last) for segment, t_first, t_last, number_of_records in read_index(path)]
+            self.logs = [None] * len(self.segments)
+        else:
+            log = open_log(path)
+            self.segments = [(path, float(log[0][0]), float(log[-1][0]))] if len(log) > 0 else []
+            self.logs = [log]
+        self.columns = read_header(self.segments[0][0]) if len(self.segments) > 0 else COLUMNS
+        self.t_firsts = [t_first for segment, t_first, t_last in self.segments]
+
+    def segment(self, n):
+        if self.logs[n] is None:
+            self.logs[n] = open_log(self.segments[n][0])
+        return self.logs[n]
+
+    def t_start(self):
+        return self.segments[0][1] if len(self.segments) > 0 else None
+
+    def t_end(self):
+        return self.segments[-1][2] if len(self.segments) > 0 else None
+
+    def window(self, t0=None, t1=None):
+        """
+        Records with t0 <= t <= t1.
+        Input:
+        `t0`(float): First time, None for the start of the log. Default = None
+        `t1`(float): Last time, None for the end of the log. Default = None
+        Returns a structured array with one field per column. Within one
+        segment this is a view of the memory map, a window over several 
+        segments is a copy.
+
+        """
+        first = 0 if t0 is None else max(bisect.bisect_right(self.t_firsts, t0) - 1, 0)
+        last = len(self.segments) if t1 is None else bisect.bisect_right(self.t_firsts, t1)
+        parts = []
+        for n in range(first, last):
+            log = self.segment(n)
+            # bisect reads log elements one by one, about log2(n) of them
+            t = log[self.columns[0]]
+            start = 0 if t0 is None else bisect.bisect_left(t, t0)
+            end = len(log) if t1 is None else bisect.bisect_right(t, t1)
+            if end > start:
+                parts.append(log[start:end])
+        if len(parts) == 0:
+            return np.zeros(0, dtype=log_dtype(self.columns))
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def window_columns(self, t0=None, t1=None):
+        """
+        Same as window(), as a float array with one row per column like
+        RingBuffer.latest(), for instance for WaveformDisplay.show_log().
+
+        """
+        log = self.window(t0, t1)
+        return log.view('<f8').reshape(len(log), len(self.columns)).T
+
+def open_log(path, mmap=True):
+    """
+    Read a binary log file.
+    Input:
+    `path`(str): Path of the log file.
+    `mmap`(bool): If True the records are memory mapped, which is
+        instantaneous and only reads the parts that are used. Otherwise all
+        records are read into memory. Compressed files are always read into
+        memory. Default = True
+    Returns a structured array with one field per column, like:
+    log['temperature1'].
+
+    """
+    dtype = log_dtype(read_header(path))
+    if path.endswith('.gz'):
+        # a file that is still being written has no end-of-stream marker,
+        # everything up to the last complete record is used
+        data = []
+        with gzip.open(path, 'rb') as f:
+            f.seek(HEADER_SIZE)
+            try:
+                chunk = f.read(65536)
+                while len(chunk) > 0:
+                    data.append(chunk)
+                    chunk = f.read(65536)
+            except EOFError:
+                pass
+        data = b''.join(data)
+        return np.frombuffer(data[:len(data) // dtype.itemsize * dtype.itemsize], dtype=dtype).copy()
+    if mmap:
+        # a record that is still being written is left out
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            number_of_records = (f.tell() - HEADER_SIZE) // dtype.itemsize
+        if number_of_records == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(number_of_records,))
+    return np.fromfile(path, dtype=dtype, offset=HEADER_SIZE)
+
+def export_text(path, text_path, delimiter='\t', chunk_size=100000):
+    """
+    Convert a binary log file to the text format of the controller, one
+    line per record with the values separated by tabs. Use delimiter=',' for
+    CSV.
+
+    """
+    log = open_log(path)
+    with open(text_path, 'w') as f:
+        for start in range(0, len(log), chunk_size):
+            chunk = log[start:start + chunk_size]
+            f.write(''.join([delimiter.join(map(str, row)) + '\n' for row in chunk.tolist()]))
@@ -0,0 +1,47 @@
+"""
+Tests of TC720Controller with a simulated device. Run with: 
+python -m pytest test_controllers.py
+"""
+import os
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('qtpy.QtWidgets')
+
+import controllers
+import widgets
+
+@pytest.fixture
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+@pytest.fixture
+def controller(monkeypatch, tmp_path):
+    #The log file is written to ~/Downloads
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / 'Downloads').mkdir()
+    controller = controllers.TC720Controller(is_simulation=True, sample_rate=5)
+    yield controller
+    controller.close()
+
+def test_set_temperature_clicks_coalesce(app, controller):
+    writes = []
+    set_temp = controller.tc720.set_temp
+    def counted_set_temp(temperature):
+        writes.append(temperature)
+        set_temp(temperature)
+    controller.tc720.set_temp = counted_set_temp
+
+    panel = widgets.ControlPanel()
+    panel.signal_tc720_parameter_update_command.connect(controller.update_controller_parameter)
+    #Clicks while the I/O thread has not started yet, so they all wait
+    for n in range(20):
+        panel.entry_set_temperature.setValue(20 + n / 10)
+        panel.update_set_temperature()
+    controller.start()
+    controller.submit('get_mode').result(timeout=10)
+
+    assert writes == [pytest.approx(21.9)]
+    assert controller.set_temperature == pytest.approx(21.9)
+    assert controller.command_stats()['coalesced'] == 19
@@ -0,0 +1,106 @@
+"""
+Tests of the batched commands of TC720 and AsyncTC720 against the emulated
+device of emulator.py. Run with: python -m pytest test_emulator.py
+"""
+import asyncio
+import os
+
+import tty
+
+import pytest
+
+if not hasattr(os, 'openpty'):
+    pytest.skip('needs a pseudo-terminal', allow_module_level=True)
+
+import TC720
+import emulator
+
+#Registers that the emulator stores without simulating them.
+COMMANDS = ['35', '36', '37']
+VALUES = [3000, 1000, 2000]
+
+@pytest.fixture
+def device():
+    device = emulator.EmulatedTC720(latency=0)
+    for command, value in zip(COMMANDS, VALUES):
+        device.registers[command] = value
+    yield device
+    device.close()
+
+def values(responses):
+    return [int(response[1:5], 16) for response in responses]
+
+@pytest.mark.parametrize('after', [0, 1])
+def test_query_many_lost_terminator(device, after):
+    tc = TC720.TC720(device.address)
+    device.inject('drop_end', after=after)
+    assert values(tc.query_many(COMMANDS, decode=False)) == VALUES
+    #The next batch is not affected by late responses
+    assert values(tc.query_many(COMMANDS, decode=False)) == VALUES
+
+def test_write_many_lost_terminator(device):
+    tc = TC720.TC720(device.address)
+    device.inject('drop_end', after=1)
+    tc.write_many({'20': '0001', '30': '0001', '47': '0002'})
+    assert device.registers['20'] == 1
+    assert device.simulation.output_enable == 1
+    assert device.registers['47'] == 2
+    assert tc.registers == {'20': '0001', '30': '0001', '47': '0002'}
+
+async def open_async(address):
+    #asyncio streams on the pseudo-terminal, without pyserial-asyncio
+    loop = asyncio.get_running_loop()
+    fd = os.open(address, os.O_RDWR | os.O_NOCTTY)
+    tty.setraw(fd)
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(os.dup(fd), 'wb', 0))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return TC720.AsyncTC720(reader, writer)
+
+@pytest.mark.parametrize('after', [0, 1])
+def test_async_query_many_lost_terminator(device, after):
+    async def run():
+        tc = await open_async(device.address)
+        device.inject('drop_end', after=after)
+        first = await tc.query_many(COMMANDS, decode=False)
+        second = await tc.query_many(COMMANDS, decode=False)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert values(first) == VALUES
+    assert values(second) == VALUES
+
+def test_async_write_many_lost_terminator(device):
+    async def run():
+        tc = await open_async(device.address)
+        device.inject('drop_end', after=1)
+        await tc.write_many({'20': '0001', '30': '0001', '47': '0002'})
+
+    asyncio.run(run())
+    assert device.registers['20'] == 1
+    assert device.simulation.output_enable == 1
+    assert device.registers['47'] == 2
+
+def test_async_idle_soak_response_is_read(device):
+    device.simulation.model.temp1 = 30
+    async def run():
+        tc = await open_async(device.address)
+        await tc.set_mode(1)
+        await tc.idle_soak()
+        return await tc.get_temp()
+
+    assert asyncio.run(run()) == pytest.approx(30, abs=0.5)
+
+def test_async_stats(device):
+    async def run():
+        tc = await open_async(device.address)
+        await tc.query_many(COMMANDS, decode=False)
+        await tc.write_register('47', '0002')
+        return tc.stats()
+
+    stats = asyncio.run(run())
+    for command in COMMANDS + ['47']:
+        assert stats[command]['sent'] == 1
+        assert stats[command]['replies'] == 1
+    assert stats['47']['write_attempts'] == 1
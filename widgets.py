@@ -13,6 +13,8 @@ import pyqtgraph as pg
 from collections import deque
 import time
 
+from buffers import RingBuffer
+
 NUMBER_OF_CHANNELS_DISPLAY = 4
 pg.setConfigOptions(antialias=True)
 
@@ -98,9 +100,9 @@ class ControlPanel(QFrame):
 			self.label_channel_readings[str(i)].setText(str(readings[i]))
 
 	def update_set_temperature(self):
-		self.signal_tc720_parameter_update_command.emit('set_mode',[0]) # get into the normal set mode
-		self.signal_tc720_parameter_update_command.emit('set_control_type',[0]) # get into the PID mode
-		self.signal_tc720_parameter_update_command.emit('set_temp',[self.entry_set_temperature.value()])
+		# one command (normal set mode, PID and the temperature), so the 
+		# controller can replace it with the next click while it waits
+		self.signal_tc720_parameter_update_command.emit('hold_temp',[self.entry_set_temperature.value()])
 
 	def update_output_enable(self,enable):
 		self.signal_tc720_parameter_update_command.emit('set_output_enable',[int(enable)]) # get into the normal set mode
@@ -108,26 +110,105 @@ class ControlPanel(QFrame):
 
 class WaveformDisplay(QFrame):
 
-	def __init__(self, main=None, *args, **kwargs):
+	# visible window in seconds, 0 is everything that is kept
+	WINDOWS = [('100 s',100),('10 min',600),('1 h',3600),('6 h',21600),('All',0)]
+
+	def __init__(self, main=None, max_fps=10, max_points=2000, buffer_capacity=360000, buffer=None, *args, **kwargs):
 		super().__init__(*args, **kwargs)
+		# samples shown in the plots. Give the buffer of the controller (or 
+		# use set_buffer()) to read from it, otherwise a buffer of 
+		# buffer_capacity samples is made and the new samples are kept here.
+		if buffer is None:
+			self.buffer = RingBuffer(buffer_capacity,['t','set_temperature','temperature1','temperature2','output'])
+			self.own_buffer = True
+		else:
+			self.buffer = buffer
+			self.own_buffer = False
+		self.count = 0
+		# samples of a log that are shown instead of the live samples
+		self.review = None
+		self.window = self.WINDOWS[0][1]
+		self.max_points = max_points
+		self.needs_redraw = False
 		self.add_components()
 		self.setFrameStyle(QFrame.Panel | QFrame.Raised)
 
+		# redraw at most max_fps times per second
+		self.timer_redraw = QTimer()
+		self.timer_redraw.timeout.connect(self.redraw)
+		self.timer_redraw.start(int(1000/max_fps))
+
 	def add_components(self):
 		self.plotWidget = {}
 		self.plotWidget['Temperature'] = PlotWidget('Temperature',add_legend=True)
 		self.plotWidget['Output'] = PlotWidget('Output')
 
+		self.dropdown_window = QComboBox()
+		for name,window in self.WINDOWS:
+			self.dropdown_window.addItem(name)
+		self.dropdown_window.currentIndexChanged.connect(self.set_window)
+
+		grid_window = QHBoxLayout()
+		grid_window.addWidget(QLabel('Window'))
+		grid_window.addWidget(self.dropdown_window)
+		grid_window.addStretch()
+
 		layout = QGridLayout() #layout = QStackedLayout()
-		layout.addWidget(self.plotWidget['Temperature'],0,0)
-		layout.addWidget(self.plotWidget['Output'],1,0)
+		layout.addLayout(grid_window,0,0)
+		layout.addWidget(self.plotWidget['Temperature'],1,0)
+		layout.addWidget(self.plotWidget['Output'],2,0)
 		self.setLayout(layout)
 
-	def plot(self,time,data):
-		self.plotWidget['Temperature'].plot(time,data[0,:],'Set Temperature',color=(255,255,255),clear=True)
-		self.plotWidget['Temperature'].plot(time,data[1,:],'Temperature 1',color=(255,200,0))
-		self.plotWidget['Temperature'].plot(time,data[2,:],'Temperature 2',color=(200,255,0))
-		self.plotWidget['Output'].plot(time,data[3,:],'Output',color=(200,200,200),clear=True)
+	def set_window(self,index):
+		self.window = self.WINDOWS[index][1]
+		self.needs_redraw = True
+
+	def set_buffer(self,buffer):
+		# read the samples from a shared buffer (columns t, set temperature,
+		# temperature 1, temperature 2, output)
+		self.buffer = buffer
+		self.own_buffer = False
+		self.needs_redraw = True
+
+	def show_log(self,data):
+		# show the samples of a log instead of the live samples, one row per
+		# column, for instance logs.LogReader(path).window_columns(t0,t1)
+		self.review = data
+		self.needs_redraw = True
+
+	def follow_live(self):
+		# show the live samples again after show_log()
+		self.review = None
+		self.needs_redraw = True
+
+	def plot(self,count,samples):
+		# count: total number of samples, samples: the new samples, one row
+		# per column
+		if self.own_buffer:
+			for i in range(samples.shape[1]):
+				self.buffer.append(samples[:len(self.buffer.columns),i])
+		self.count = count
+		if self.review is None:
+			self.needs_redraw = True
+
+	def redraw(self):
+		if self.needs_redraw == False:
+			return
+		if self.review is not None:
+			data = self.review
+		else:
+			data = self.buffer.latest(count=min(self.count,self.buffer.count))
+		if data.shape[1] == 0:
+			return
+		self.needs_redraw = False
+		start = 0
+		if self.window > 0:
+			start = np.searchsorted(data[0],data[0,-1]-self.window)
+		time = data[0,start:]
+		self.plotWidget['Temperature'].plot(*minmax_decimate(time,data[1,start:],self.max_points),'Set Temperature',color=(255,255,255))
+		self.plotWidget['Temperature'].plot(*minmax_decimate(time,data[2,start:],self.max_points),'Temperature 1',color=(255,200,0))
+		self.plotWidget['Temperature'].plot(*minmax_decimate(time,data[3,start:],self.max_points),'Temperature 2',color=(200,255,0))
+		self.plotWidget['Output'].plot(*minmax_decimate(time,data[4,start:],self.max_points),'Output',color=(200,200,200))
 
 class PlotWidget(pg.GraphicsLayoutWidget):
 	
@@ -136,6 +217,37 @@ class PlotWidget(pg.GraphicsLayoutWidget):
 		self.plotWidget = self.addPlot(title = '', axisItems = {'bottom': pg.DateAxisItem()})
 		if add_legend:
 			self.plotWidget.addLegend()
+		# one curve per label, updated in place
+		self.curves = {}
 	
 	def plot(self,x,y,label,color,clear=False):
-		self.plotWidget.plot(x[-1000:],y[-1000:],pen=pg.mkPen(color=color,width=2),name=label,clear=clear)
+		if clear:
+			self.plotWidget.clear()
+			self.curves = {}
+		if label not in self.curves:
+			self.curves[label] = self.plotWidget.plot(pen=pg.mkPen(color=color,width=2),name=label)
+		self.curves[label].setData(x,y)
+
+def minmax_decimate(x,y,max_points):
+	# reduce a curve to at most max_points points, keeping the minimum and
+	# maximum of every bin so peaks stay visible
+	if len(x) <= max_points:
+		return x,y
+	bins = max_points//2
+	size = len(x)//bins
+	start = len(x) - bins*size
+	x_bins = x[start:].reshape(bins,size)
+	y_bins = y[start:].reshape(bins,size)
+	i_min = y_bins.argmin(axis=1)
+	i_max = y_bins.argmax(axis=1)
+	rows = np.arange(bins)
+	# keep the order in time of the minimum and maximum within a bin
+	first = np.minimum(i_min,i_max)
+	second = np.maximum(i_min,i_max)
+	x_decimated = np.empty(2*bins)
+	y_decimated = np.empty(2*bins)
+	x_decimated[0::2] = x_bins[rows,first]
+	x_decimated[1::2] = x_bins[rows,second]
+	y_decimated[0::2] = y_bins[rows,first]
+	y_decimated[1::2] = y_bins[rows,second]
+	return x_decimated,y_decimated